@@ -0,0 +1,120 @@
+"""
+Get and set the CPU affinity of processes and look up NUMA topology (Linux).
+
+Python 2 has no os.sched_setaffinity, so this calls the libc functions
+through ctypes. Affinities are lists of CPU numbers.
+"""
+import os
+import glob
+import ctypes
+from os.path import *
+
+import sysutil
+
+class Error(Exception):
+    pass
+
+CPU_SETSIZE = 1024
+
+class _CpuSet(ctypes.Structure):
+    _fields_ = [ ('bits', ctypes.c_ulong * (CPU_SETSIZE / (8 * ctypes.sizeof(ctypes.c_ulong)))) ]
+
+def _get_libc():
+    libc = sysutil.libc()
+    if not hasattr(libc, 'sched_setaffinity'):
+        raise Error("sched_setaffinity not supported on this system")
+
+    return libc
+
+def _bits_per_word():
+    return 8 * ctypes.sizeof(ctypes.c_ulong)
+
+def getaffinity(pid=0):
+    """Return the CPUs process 'pid' (default: the calling thread) may run on"""
+    cpuset = _CpuSet()
+    if _get_libc().sched_getaffinity(pid, ctypes.sizeof(cpuset), ctypes.byref(cpuset)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    bits = _bits_per_word()
+    return [ cpu for cpu in range(CPU_SETSIZE)
+             if cpuset.bits[cpu / bits] & (1 << (cpu % bits)) ]
+
+def setaffinity(cpus, pid=0):
+    """Restrict process 'pid' (default: the calling thread) to 'cpus'"""
+    if not cpus:
+        raise Error("can't set an empty affinity")
+
+    cpuset = _CpuSet()
+    bits = _bits_per_word()
+    for cpu in cpus:
+        if not 0 <= cpu < CPU_SETSIZE:
+            raise Error("cpu %d out of range" % cpu)
+        cpuset.bits[cpu / bits] |= 1 << (cpu % bits)
+
+    if _get_libc().sched_setaffinity(pid, ctypes.sizeof(cpuset), ctypes.byref(cpuset)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+def parse_cpulist(s):
+    """Parse a kernel cpu list (e.g., "0-3,8,10-11") into a list of CPUs"""
+    cpus = []
+    for field in s.strip().split(','):
+        if not field:
+            continue
+
+        if '-' in field:
+            first, last = field.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(field))
+
+    return cpus
+
+def numa_nodes():
+    """Return a list of the CPUs of each NUMA node.
+
+    Systems without NUMA information in sysfs look like a single node.
+    """
+    nodes = []
+
+    paths = glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')
+    paths.sort(key=lambda path: int(basename(dirname(path))[4:]))
+    for path in paths:
+        cpus = parse_cpulist(file(path).read())
+        if cpus:
+            nodes.append(cpus)
+
+    if not nodes:
+        nodes = [ getaffinity() ]
+
+    return nodes
+
+def placements(policy, count):
+    """Return the CPUs to restrict each of 'count' workers to.
+
+    'policy':
+        "core": a different CPU for each worker (round-robin if there
+                are more workers than CPUs)
+        "numa": the CPUs of one NUMA node, spreading workers across nodes
+        "inherit": the CPUs the calling process may run on
+
+    Only CPUs the calling process may run on are used, so placements stay
+    within an inherited cpuset.
+    """
+    allowed = getaffinity()
+
+    if policy == "inherit":
+        return [ allowed ] * count
+
+    if policy == "core":
+        return [ [ allowed[i % len(allowed)] ] for i in range(count) ]
+
+    if policy == "numa":
+        nodes = [ [ cpu for cpu in node if cpu in allowed ]
+                  for node in numa_nodes() ]
+        nodes = [ node for node in nodes if node ] or [ allowed ]
+
+        return [ nodes[i % len(nodes)] for i in range(count) ]
+
+    raise Error("unknown placement policy %s" % `policy`)
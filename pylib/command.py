@@ -14,11 +14,14 @@ import signal
 import time
 import select
 import re
+import sre_parse
+import sre_constants
 import sys
 import errno
 import termios
 
 import popen4
+import exitwatch
 from fifobuffer import FIFOBuffer
 from fileevent import *
 
@@ -58,6 +61,105 @@ def set_blocking(fd, blocking):
     else:
         fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
 
+def _search_back(pattern_re):
+    """Return how far before new output a search for 'pattern_re' must
+    start to find every match an earlier search couldn't see, or None if
+    that isn't bounded (e.g., the pattern has unbounded repeats, lookaheads
+    or backreferences)"""
+    try:
+        parsed = sre_parse.parse(pattern_re.pattern, pattern_re.flags)
+    except sre_constants.error:
+        return None
+
+    # assertions like \b or $ look at the character after them, so a match
+    # ending where the output ended may only succeed once more comes
+    peeks = []
+
+    def looks_ahead(data):
+        for op, av in data:
+            if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+                return True
+
+            if op == sre_constants.AT and av not in (sre_constants.AT_BEGINNING,
+                                                     sre_constants.AT_BEGINNING_LINE,
+                                                     sre_constants.AT_BEGINNING_STRING):
+                peeks.append(av)
+
+            subpatterns = []
+            if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                # lookbehinds are fine, we search with the preceding output
+                if av[0] > 0:
+                    return True
+                subpatterns = [ av[1] ]
+            elif op == sre_constants.BRANCH:
+                subpatterns = av[1]
+            elif op == sre_constants.SUBPATTERN:
+                subpatterns = [ av[-1] ]
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                subpatterns = [ av[2] ]
+
+            for subpattern in subpatterns:
+                if looks_ahead(subpattern):
+                    return True
+
+        return False
+
+    if looks_ahead(parsed):
+        return None
+
+    lo, hi = parsed.getwidth()
+    if hi >= sre_constants.MAXREPEAT:
+        return None
+
+    # a match we haven't seen ends after the searched output, so it starts
+    # at most hi - 1 bytes before it. Unless it peeks past its end.
+    if peeks:
+        return hi
+
+    return max(hi - 1, 0)
+
+class _Patterns:
+    """Patterns to search output for (see Command.outputsearch)"""
+    def __init__(self, p, overlap=4096):
+        patterns = []
+        if not type(p) in (tuple, list):
+            patterns.append(p)
+        else:
+            patterns += p
+
+        # compile all patterns into re objects, but keep the original pattern object
+        # so we can return it to the user when we match (friendlier interface)
+        re_type = type(re.compile(""))
+        for i in xrange(len(patterns)):
+            if type(patterns[i]) is not re_type:
+                patterns[i] = (re.compile(patterns[i]), patterns[i])
+            else:
+                patterns[i] = (patterns[i], patterns[i])
+
+        self.compiled = patterns
+
+        # how far before the new output a match we haven't seen could start
+        self.overlaps = []
+        for pattern_re, pattern_orig in patterns:
+            search_back = _search_back(pattern_re)
+            if search_back is None:
+                self.overlaps.append(overlap)
+            else:
+                self.overlaps.append(search_back)
+
+    def search(self, output, searched=0):
+        """Search 'output' for the first pattern that matches, except where
+        an earlier search of its first 'searched' bytes ruled out a match.
+
+        Return a tuple (the pattern we matched, the string match) or None
+        """
+        for (pattern_re, pattern_orig), overlap in zip(self.compiled, self.overlaps):
+            match = pattern_re.search(output, max(searched - overlap, 0))
+            if match:
+                return pattern_orig, match
+
+        return None
+
 class FileEnhancedRead:
     def __init__(self, fh):
         self.fh = fh
@@ -202,6 +304,7 @@ class Command(object):
         self._cmd = cmd
         
         self._output = FIFOBuffer()
+        self._exitwatch = None
         self._dprint("# command started (pid=%d, pty=%s): %s" % (self._child.pid,
                                                                `pty`,
                                                                cmd))
@@ -213,6 +316,9 @@ class Command(object):
         # don't terminate() a process we didn't start
         if os.getpid() == self.ppid:
             self.terminate()
+
+        if self._exitwatch:
+            self._exitwatch.close()
         
     def _dprint(self, msg):
         if self._debug:
@@ -242,10 +348,8 @@ class Command(object):
 
                 return
             
-            for i in range(gracetime):
-                if not self.running:
-                    return
-                time.sleep(1)
+            if gracetime and self.wait(timeout=gracetime):
+                return
 
             if self.running:
                 os.kill(pid, signal.SIGKILL)
@@ -283,10 +387,20 @@ class Command(object):
         return os.WEXITSTATUS(status)
     exitcode = property(exitcode)
 
+    def _watch(self):
+        """Return an exitwatch.Watch for the command, or None if we can't watch it"""
+        if self._exitwatch is None:
+            try:
+                self._exitwatch = exitwatch.Watch(self.pid)
+            except (exitwatch.Error, OSError):
+                self._exitwatch = False
+
+        return self._exitwatch or None
+
     def wait(self, timeout=None, poll_interval=0.2, callback=None):
         """wait for process to finish executing.
         'timeout' is how long we wait in seconds (None is forever)
-        'poll_interval' is how long we sleep between checks to see if process has finished
+        'poll_interval' is how often we call 'callback' (and check if the process has finished, if we can't be notified when it does)
         'callback': you can use callback to check for other conditions (e.g., besides timeout) and stop wait early.
 
         return value: did the process finish? True/False
@@ -300,15 +414,25 @@ class Command(object):
             return True
         else:
             start=time.time()
-            while time.time() - start < timeout:
+            watch = self._watch()
+            while True:
                 if callback and callback() is False:
                     return False
 
                 if not self.running:
                     return True
-                time.sleep(poll_interval)
 
-            return False
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    return False
+
+                if callback or watch is None:
+                    remaining = min(remaining, poll_interval)
+
+                if watch is None:
+                    time.sleep(remaining)
+                else:
+                    exitwatch.wait([ watch ], remaining)
 
     def output(self):
         if len(self._output):
@@ -343,7 +467,7 @@ class Command(object):
 
     fromchild = property(fromchild)
         
-    def outputsearch(self, p, timeout=None, linemode=False):
+    def outputsearch(self, p, timeout=None, linemode=False, overlap=4096):
         """Search for 'p' in the command's output, while listening for more output from command, within 'timeout'
 
         'p' can be a list of re patterns or a single re pattern
@@ -351,6 +475,12 @@ class Command(object):
         If 'timeout' is None, wait forever [*]
 
 	'linemode' determines whether we search output line by line (as it comes), or all of the output in aggregate
+
+        'overlap' in aggregate mode, as output comes only the new output is
+           searched, plus the last 'overlap' bytes before it (in case a
+           match started there). Patterns that can only match a bounded
+           length (e.g., no '*' or '+', lookaheads or backreferences)
+           search back only as far as their longest match instead.
         
         Return value:
         Did we match the output?
@@ -364,20 +494,10 @@ class Command(object):
         - Output is collected and can be accessed by the output attribute [*]
         """
         
-        patterns = []
-        if not type(p) in (tuple, list):
-            patterns.append(p)
-        else:
-            patterns += p
+        patterns = _Patterns(p, overlap)
 
-        # compile all patterns into re objects, but keep the original pattern object
-        # so we can return it to the user when we match (friendlier interface)
-        re_type = type(re.compile(""))
-        for i in xrange(len(patterns)):
-            if type(patterns[i]) is not re_type:
-                patterns[i] = (re.compile(patterns[i]), patterns[i])
-            else:
-                patterns[i] = (patterns[i], patterns[i])
+        # how much of the output we've searched
+        searched = [0]
 
         def check_match():
             if linemode:
@@ -386,7 +506,7 @@ class Command(object):
                     if not line:
                         return None
                     
-                    for pattern_re, pattern_orig in patterns:
+                    for pattern_re, pattern_orig in patterns.compiled:
                         match = pattern_re.search(line)
                         if match:
                             return pattern_orig, match
@@ -395,11 +515,12 @@ class Command(object):
                         return None
                         
             else:
-                # match against the entire buffered output
-                for pattern_re, pattern_orig in patterns:
-                    match = pattern_re.search(self._output.getvalue())
-                    if match:
-                        return pattern_orig, match
+                # match against the buffered output we haven't searched yet
+                output = self._output.getvalue()
+                m = patterns.search(output, searched[0])
+                searched[0] = len(output)
+
+                return m
             
         # maybe we already match? (in buffered output)
         m = check_match()
@@ -510,6 +631,348 @@ class CommandTrue:
         else:
             return True
 
+class CommandGroup:
+    """Run many Commands under one epoll loop.
+
+    The output and exit (see exitwatch) file descriptors of all commands
+    are registered in a single epoll set once, instead of each command
+    polling its own output.
+
+    Usage example::
+
+        group = CommandGroup([ Command(["make", "-C", d]) for d in dirs ])
+        group.trigger("error:", lambda c, pattern, match: c.terminate())
+        group.wait()
+
+        for c in group.commands:
+            print c.exitcode, c.output
+
+    While a command is in a group, the group reads its output: get it from
+    command.output, callbacks or triggers, not from command.fromchild.
+    """
+    class _Trigger:
+        def __init__(self, patterns, callback, command):
+            self.patterns = patterns
+            self.callback = callback
+            self.command = command
+
+            # command -> how much of its output we've searched
+            self.searched = {}
+
+    READ_SIZE = 65536
+
+    def __init__(self, commands=()):
+        self.commands = []
+        self.finished = []
+
+        self._epoll = select.epoll()
+        self._outputs = {}      # output fd -> command
+        self._exits = {}        # exit fd -> commands (shared by SIGCHLD watches)
+        self._polled = []       # commands we can't be notified of exiting
+        self._callbacks = {}
+        self._triggers = []
+
+        for command in commands:
+            self.add(command)
+
+    def fileno(self):
+        """File descriptor that is readable when poll() has events to handle
+        (unless some commands can't be watched for exiting)"""
+        return self._epoll.fileno()
+
+    def add(self, command, callback=None):
+        """Add 'command' to the group.
+
+        'callback': callback(command, readbuf) for every read of the
+                    command's output. readbuf is an empty string on EOF.
+                    If callback returns False, the command is removed from
+                    the group.
+        """
+        self.commands.append(command)
+        if callback:
+            self._callbacks[command] = callback
+
+        fd = command._child.fromchild.fileno()
+        set_blocking(fd, False)
+        self._epoll.register(fd, select.EPOLLIN)
+        self._outputs[fd] = command
+
+        watch = command._watch()
+        if watch is None:
+            self._polled.append(command)
+        else:
+            exit_fd = watch.fileno()
+            if exit_fd not in self._exits:
+                self._epoll.register(exit_fd, select.EPOLLIN)
+                self._exits[exit_fd] = []
+            self._exits[exit_fd].append(command)
+
+        # maybe it exited before we could watch it
+        if not command.running:
+            self._exited(command)
+
+        for trigger in self._triggers[:]:
+            self._check(trigger, command)
+
+    def remove(self, command):
+        """Remove 'command' from the group. Its output is no longer read"""
+        for fd, c in self._outputs.items():
+            if c is command:
+                self._close_output(fd)
+
+        self._unwatch(command)
+
+        self.commands.remove(command)
+        if command in self.finished:
+            self.finished.remove(command)
+        self._callbacks.pop(command, None)
+        for trigger in self._triggers:
+            trigger.searched.pop(command, None)
+
+    def close(self):
+        for command in self.commands[:]:
+            self.remove(command)
+
+        self._epoll.close()
+
+    def trigger(self, p, callback, command=None, overlap=4096):
+        """Call callback(command, pattern, match) once when the output of
+        'command' (any command in the group if None) matches 'p'.
+
+        'p' and 'overlap' are as in Command.outputsearch (aggregate mode).
+        Output the commands already have is searched too.
+
+        Returns the trigger, to untrigger() it before it fires.
+        """
+        trigger = self._Trigger(_Patterns(p, overlap), callback, command)
+        self._triggers.append(trigger)
+
+        for command in self.commands[:]:
+            self._check(trigger, command)
+
+        return trigger
+
+    def untrigger(self, trigger):
+        if trigger in self._triggers:
+            self._triggers.remove(trigger)
+
+    def _check(self, trigger, command):
+        # an earlier trigger's callback may have removed it
+        if trigger not in self._triggers or command not in self.commands:
+            return
+
+        if trigger.command not in (None, command):
+            return
+
+        output = command._output.getvalue()
+        m = trigger.patterns.search(output, trigger.searched.get(command, 0))
+        trigger.searched[command] = len(output)
+
+        if m:
+            self._triggers.remove(trigger)
+            pattern, match = m
+            trigger.callback(command, pattern, match)
+
+    def _close_output(self, fd):
+        self._epoll.unregister(fd)
+        del self._outputs[fd]
+        set_blocking(fd, True)
+
+    def _read(self, fd):
+        """Read output from 'fd' and dispatch it. Return what we read
+        ('' on EOF) or None if there wasn't anything to read"""
+        command = self._outputs[fd]
+        try:
+            buf = os.read(fd, self.READ_SIZE)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return None
+
+            # reading a pty fails once the child side is closed
+            if e.errno != errno.EIO:
+                raise
+            buf = ''
+
+        if buf:
+            command._dprint("# EVENT 'read':\n%s" % buf)
+            command._output.write(buf)
+        else:
+            self._close_output(fd)
+
+        callback = self._callbacks.get(command)
+        if callback and callback(command, buf) is False:
+            self.remove(command)
+            return buf
+
+        if buf:
+            for trigger in self._triggers[:]:
+                self._check(trigger, command)
+
+        return buf
+
+    def _unwatch(self, command):
+        if command in self._polled:
+            self._polled.remove(command)
+
+        for exit_fd, commands in self._exits.items():
+            if command in commands:
+                commands.remove(command)
+                if not commands:
+                    self._epoll.unregister(exit_fd)
+                    del self._exits[exit_fd]
+
+    def _exited(self, command):
+        self._unwatch(command)
+
+        # read what it wrote before exiting
+        for fd, c in self._outputs.items():
+            if c is command:
+                while fd in self._outputs and self._read(fd):
+                    pass
+
+        if command in self.commands:
+            self.finished.append(command)
+
+    def poll(self, timeout=None):
+        """Wait up to 'timeout' seconds (None is forever) for output and
+        exits and dispatch them. Returns how many events we handled."""
+        if self._polled and (timeout is None or timeout > 0.2):
+            timeout = 0.2
+
+        if timeout is None:
+            timeout = -1
+
+        try:
+            events = self._epoll.poll(timeout)
+        except IOError, e:
+            if e.errno != errno.EINTR:
+                raise
+            events = []
+
+        for fd, mask in events:
+            if fd in self._outputs:
+                self._read(fd)
+
+            elif fd in self._exits:
+                commands = self._exits[fd]
+                commands[0]._exitwatch.drain()
+
+                for command in commands[:]:
+                    if not command.running:
+                        self._exited(command)
+
+        for command in self._polled[:]:
+            if not command.running:
+                self._exited(command)
+
+        return len(events)
+
+    def _run(self, done, timeout):
+        started = time.time()
+        while not done():
+            if not (self._outputs or self._exits or self._polled):
+                break
+
+            remaining = None
+            if timeout is not None:
+                remaining = timeout - (time.time() - started)
+                if remaining <= 0:
+                    break
+
+            self.poll(remaining)
+
+        return done()
+
+    def running(self):
+        finished = set(self.finished)
+        return [ command for command in self.commands
+                 if command not in finished ]
+    running = property(running)
+
+    def wait(self, timeout=None):
+        """wait for all commands to finish, within 'timeout' (None is forever)
+
+        return value: did they all finish? True/False
+        """
+        return self._run(lambda: len(self.finished) == len(self.commands), timeout)
+
+    def wait_any(self, timeout=None):
+        """wait for any running command to finish, within 'timeout' (None is forever)
+
+        return value: the commands that finished (empty on timeout)
+        """
+        finished = len(self.finished)
+        self._run(lambda: len(self.finished) > finished or
+                          len(self.finished) == len(self.commands), timeout)
+
+        return self.finished[finished:]
+
+    def outputsearch(self, p, timeout=None, overlap=4096):
+        """Search for 'p' in the output of the commands, while listening for
+        more output, within 'timeout' (see Command.outputsearch)
+
+        Return value:
+        Did we match the output?
+            Return a tuple (the command, the pattern we matched, the string match)
+        Otherwise (timeout/all commands finished) Return empty tuple ()
+        """
+        found = []
+        def callback(command, pattern, match):
+            found.append((command, pattern, match))
+
+        trigger = self.trigger(p, callback, overlap=overlap)
+        try:
+            self._run(lambda: found, timeout)
+        finally:
+            self.untrigger(trigger)
+
+        if found:
+            return found[0]
+
+        return ()
+
+def wait(commands, timeout=None):
+    """wait for any of 'commands' to finish, within 'timeout' (None is forever)
+
+    return value: the commands that finished (empty on timeout)
+    """
+    commands = list(commands)
+    if not commands:
+        return []
+
+    watched = {}
+    polled = []
+    for c in commands:
+        watch = c._watch()
+        if watch is None:
+            polled.append(c)
+        else:
+            watched[watch] = c
+
+    started = time.time()
+    candidates = commands
+    while True:
+        finished = [ c for c in candidates if not c.running ]
+        if finished:
+            return finished
+
+        remaining = None
+        if timeout is not None:
+            remaining = timeout - (time.time() - started)
+            if remaining <= 0:
+                return []
+
+        if polled and (remaining is None or remaining > 0.2):
+            remaining = 0.2
+
+        if watched:
+            ready = exitwatch.wait(watched.keys(), remaining)
+        else:
+            time.sleep(remaining)
+            ready = []
+
+        candidates = [ watched[watch] for watch in ready ] + polled
+
 last_exitcode = None
 last_output = None
 
@@ -544,3 +1007,93 @@ def output(cmd):
     last_exitcode = c.exitcode
 
     return last_output
+
+def benchmark_outputsearch(sizes=(1, 4, 16)):
+    """feed a chatty build log of 'sizes' MB through outputsearch()"""
+
+    script = "\n".join([
+        "import sys",
+        "line = 'CC  src/module%d.o -O2 -Wall -Iinclude -DNDEBUG\\n'",
+        "for i in xrange(int(sys.argv[1])):",
+        "    sys.stdout.write(line % i)",
+        "sys.stdout.write('BUILD FINISHED\\n')" ])
+
+    for size in sizes:
+        lines = (size << 20) / len("CC  src/module00000.o -O2 -Wall -Iinclude -DNDEBUG\n")
+
+        for p in ("BUILD FINISHED", r"BUILD \w+ED\n"):
+            c = Command([ sys.executable, "-c", script, str(lines) ])
+            started = time.time()
+            cpu_started = sum(os.times()[:2])
+            m = c.outputsearch(p)
+            elapsed = time.time() - started
+            cpu = sum(os.times()[:2]) - cpu_started
+
+            assert m, "no match"
+            print "%4d MB %-18s %6.2f s elapsed %6.2f s cpu %8.1f MB/s" % \
+                  (size, `p`, elapsed, cpu, len(c.output) / elapsed / (1 << 20))
+
+def benchmark_wait(runs=20, commands=200):
+    """measure how much later than waitpid() timed waits notice a command finished"""
+
+    def elapsed(timeout):
+        total = 0
+        for i in range(runs):
+            c = Command([ "sleep", "0.05" ])
+            started = time.time()
+            c.wait(timeout)
+            total += time.time() - started
+
+        return total / runs
+
+    blocking = elapsed(None)
+    timed = elapsed(10)
+    print "wait():           %6.1f ms" % (blocking * 1000)
+    print "wait(timeout=10): %6.1f ms (%.1f ms notification latency)" % \
+          (timed * 1000, (timed - blocking) * 1000)
+
+    cs = [ Command([ "sleep", "0.%d" % (i % 5 + 1) ]) for i in range(commands) ]
+    started = time.time()
+    wakeups = 0
+    while cs:
+        finished = wait(cs, 10)
+        cs = [ c for c in cs if c not in finished ]
+        wakeups += 1
+
+    print "%d commands: all finished after %.2f s, %d wakeups" % \
+          (commands, time.time() - started, wakeups)
+
+def benchmark_group(commands=100):
+    """compare reading many commands round-robin vs. with a CommandGroup"""
+
+    # a chatty build step: a burst of output every 0.1 seconds for 2 seconds
+    argv = [ "sh", "-c", "for i in $(seq 1 20); do seq 1 200; sleep 0.1; done" ]
+
+    def round_robin(cs):
+        while cs:
+            idle = True
+            for c in cs[:]:
+                output = c.fromchild.read(timeout=0)
+                if output:
+                    idle = False
+                elif output == '':
+                    c.wait()
+                    cs.remove(c)
+
+            if idle:
+                time.sleep(0.01)
+
+    def group(cs):
+        CommandGroup(cs).wait()
+
+    for name, run in (("round-robin", round_robin), ("CommandGroup", group)):
+        started = time.time()
+        cpu_started = sum(os.times()[:2])
+        cs = [ Command(argv) for i in range(commands) ]
+        run(cs[:])
+        elapsed = time.time() - started
+        cpu = sum(os.times()[:2]) - cpu_started
+
+        assert [ len(c.output) for c in cs ] == [ len(cs[0].output) ] * commands
+        print "%-12s %d commands: %6.2f s elapsed %6.2f s cpu" % (name, commands,
+                                                                  elapsed, cpu)
@@ -0,0 +1,182 @@
+"""
+Get notified when child processes exit, without polling (Linux).
+
+A Watch has a file descriptor that becomes readable when its child exits,
+so it can be waited on with select/poll/epoll alongside other file
+descriptors. Where the kernel supports it (Linux 5.3+) that's a pidfd of
+the child. Otherwise all watches share a pipe that a SIGCHLD handler
+writes to, which becomes readable when any child exits.
+
+Python 2 has no os.pidfd_open, so this calls the syscall through ctypes.
+"""
+import os
+import errno
+import signal
+import select
+import time
+import math
+import ctypes
+
+import sysutil
+
+class Error(Exception):
+    pass
+
+# the same on all architectures (added after the syscall tables were unified)
+SYS_PIDFD_OPEN = 434
+
+def pidfd_open(pid):
+    """Return a pidfd that becomes readable when process 'pid' exits.
+    Raises OSError (e.g., ENOSYS) if the kernel can't."""
+    fd = sysutil.libc().syscall(SYS_PIDFD_OPEN, pid, 0)
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+    return fd
+
+class _SigchldPipe:
+    """Pipe that becomes readable when any child exits.
+
+    Installing the SIGCHLD handler is only possible from the main thread.
+    """
+    def __init__(self):
+        self._r, self._w = sysutil.nonblocking_pipe()
+
+        self._previous = signal.signal(signal.SIGCHLD, self._handler)
+
+        # don't fail the process's slow system calls with EINTR
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+        # Python only runs signal handlers in the main thread, between
+        # bytecodes. The wakeup fd is written to as soon as the signal
+        # arrives, so waits in other threads wake up immediately too.
+        # Unless someone else is already using it.
+        previous = signal.set_wakeup_fd(self._w)
+        if previous != -1:
+            signal.set_wakeup_fd(previous)
+
+    def _handler(self, signum, frame):
+        try:
+            os.write(self._w, '\0')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        if callable(self._previous):
+            self._previous(signum, frame)
+
+    def fileno(self):
+        return self._r
+
+    def drain(self):
+        try:
+            while os.read(self._r, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+_pidfd_supported = None
+_sigchld = None
+
+class Watch:
+    """Watch for child 'pid' to exit.
+
+    If .shared is True, fileno() is shared with all other shared watches
+    and becomes readable when any child exits. Call drain() before checking
+    (e.g., with waitpid) which children exited.
+
+    The watch doesn't reap the child.
+    """
+    def __init__(self, pid):
+        global _pidfd_supported, _sigchld
+
+        self.pid = pid
+        self.shared = False
+        self._fd = None
+
+        if _pidfd_supported is not False:
+            try:
+                self._fd = pidfd_open(pid)
+                _pidfd_supported = True
+                return
+            except OSError, e:
+                # ESRCH: there's no such process (anymore)
+                if e.errno == errno.ESRCH:
+                    raise
+
+                # ENOSYS: kernel too old, EPERM: filtered by seccomp
+                _pidfd_supported = False
+
+        if _sigchld is None:
+            try:
+                _sigchld = _SigchldPipe()
+            except ValueError:
+                raise Error("can't watch for child exits without pidfd "
+                            "support outside the main thread")
+
+        self.shared = True
+
+    def __del__(self):
+        self.close()
+
+    def fileno(self):
+        if self.shared:
+            return _sigchld.fileno()
+
+        return self._fd
+
+    def drain(self):
+        if self.shared:
+            _sigchld.drain()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+def wait(watches, timeout=None):
+    """Wait for any of 'watches' to become readable, within 'timeout'
+    (None is forever).
+
+    Return the watches whose children may have exited (shared watches
+    can wake up for other children) or an empty list on timeout.
+    """
+    watches = list(watches)
+
+    by_fd = {}
+    for watch in watches:
+        by_fd.setdefault(watch.fileno(), []).append(watch)
+
+    # unlike select, poll isn't limited to FD_SETSIZE file descriptors
+    poller = select.poll()
+    for fd in by_fd:
+        poller.register(fd, select.POLLIN)
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    while True:
+        if timeout is None:
+            ms = None
+        else:
+            ms = max(int(math.ceil((deadline - time.time()) * 1000)), 0)
+
+        try:
+            events = poller.poll(ms)
+            break
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+
+    ready = []
+    for fd, event in events:
+        ready.extend(by_fd[fd])
+
+    for watch in ready:
+        if watch.shared:
+            watch.drain()
+            break
+
+    return ready
@@ -24,7 +24,12 @@ class FIFOBuffer:
             return buf
 
     def write(self, s):
-        self.buf += s
+        # while we hold the only reference CPython appends in place.
+        # self.buf += s would copy the whole buffer on every write.
+        buf = self.buf
+        self.buf = None
+        buf += s
+        self.buf = buf
 
     def readline(self, read_incomplete=False):
         """Read a line from the buffer.
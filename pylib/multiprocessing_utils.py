@@ -7,81 +7,867 @@
 # published by the Free Software Foundation; either version 3 of the
 # License, or (at your option) any later version.
 
+import os
+import sys
 import signal
+import errno
+import select
+import threading
 
 import time
-from multiprocessing import Process, Event, Condition, Value
-from multiprocessing.queues import Queue, Empty
+import math
+import traceback
+import resource
+import itertools
+import heapq
+import bisect
+import json
+import binascii
+import cPickle
+import socket
+import struct
+import hmac
+import hashlib
+from collections import deque
+from multiprocessing import Process, Event, Condition, Lock, RawValue, RawArray
+from multiprocessing import AuthenticationError, current_process
+from multiprocessing.queues import Queue, Empty, Full
+from Queue import Queue as ThreadQueue
 
 from threadloop import ThreadLoop
+import affinity
+import shmbuffer
+import sysutil
+from shmbuffer import ShmHandle, SharedBuffer
+
+class PipeEvent:
+    """threading.Event lookalike backed by a pipe.
+
+    While the event is set the read end of the pipe is readable, so unlike
+    threading.Event (which polls in Python 2) wait() wakes up immediately and
+    the event can be watched with select/poll alongside other file descriptors.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flag = False
+
+        self._r, self._w = sysutil.nonblocking_pipe()
+
+    def __del__(self):
+        for fd in (self._r, self._w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def fileno(self):
+        return self._r
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        self._lock.acquire()
+        try:
+            if not self._flag:
+                self._flag = True
+                os.write(self._w, '\0')
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            if self._flag:
+                self._flag = False
+                try:
+                    os.read(self._r, 1)
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+        finally:
+            self._lock.release()
+
+    def wait(self, timeout=None):
+        """Wait until the event is set. Returns the flag on exit (False on timeout)"""
+        if self._flag:
+            return True
+
+        try:
+            select.select([self._r], [], [], timeout)
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+
+        return self._flag
+
+class _Chunk(list):
+    """A batch of inputs or return values that travels through a queue as
+    a single item"""
+    pass
+
+class _Task:
+    """An input tagged with the id of its call.
+
+    If 'future' is set a Future is waiting for the result, so an exception
+    the call raises is handed to it instead of crashing the worker.
+    """
+    def __init__(self, id, input, future=False):
+        self.id = id
+        self.input = input
+        self.future = future
+
+class _Queued:
+    """An input stamped with the time it was submitted"""
+    def __init__(self, input, at):
+        self.input = input
+        self.at = at
+
+class _Crashed:
+    """An input that crashed a worker 'crashes' times"""
+    def __init__(self, input, crashes):
+        self.input = input
+        self.crashes = crashes
+
+class _DeadLetter:
+    """An input that exhausted its retries, with the last traceback"""
+    def __init__(self, input, traceback):
+        self.input = input
+        self.traceback = traceback
+
+class _TaskResult:
+    def __init__(self, id, retval=None, exception=None):
+        self.id = id
+        self.retval = retval
+        self.exception = exception
 
 class WaitableQueue(Queue):
-    """Queue that uses a semaphore to reliably count items in it"""
-    class Vacuum(ThreadLoop):
-        def __init__(self, q, l):
+    """Queue that uses a semaphore to reliably count items in it
+
+    If 'shm_threshold' is set, strings of at least that many bytes (in
+    items, chunks, tasks, results and argument tuples) are passed through
+    shared memory instead of being pickled through the queue's pipe. They
+    come out of get() as zero-copy shmbuffer.SharedBuffer objects.
+
+    put_many() and get_many() move batches of items, paying for locking,
+    counting and empty/notempty signalling once per batch instead of once
+    per item.
+    """
+    # how often waiters recheck the queue in case a put or get raced with
+    # them registering and didn't notify them
+    WAIT_RECHECK = 0.1
+
+    class Collector:
+        def __init__(self, q, l, collected=None, maxsize=0):
+            """Move items from queue 'q' into list 'l' when collect() is called.
+
+            For event loops: watch fileno() with select/poll and call
+            collect() when it's readable. See Vacuum for a background thread
+            that does this.
+
+            Chunks are unbatched into their items.
+
+            If 'collected' is set it is called with the number of items moved
+            after each batch.
+
+            If 'maxsize' is set, stop moving items while 'l' holds that many.
+            Whoever removes items from 'l' should set the .room event.
+            """
+            self.q = q
+            self.l = l
+            self.collected = collected
+            self.maxsize = maxsize
+            self.room = PipeEvent()
+            self.room.set()
+
+        # most items to get from the queue at a time
+        BATCH = 256
+
+        def fileno(self):
+            """File descriptor that is readable when the queue may have items"""
+            return self.q.fileno()
+
+        def full(self):
+            return self.maxsize and len(self.l) >= self.maxsize
+
+        def collect(self, timeout=0):
+            """Move the items that are queued into the list. Returns how many.
+
+            'timeout': how long to wait for another reader of the queue
+            """
+            count = 0
+            while not self.full():
+                if self.maxsize:
+                    batch = self.maxsize - len(self.l)
+                else:
+                    batch = self.BATCH
+
+                vals = self.q.get_many(batch, timeout=timeout)
+                if not vals:
+                    break
+
+                for val in vals:
+                    count += self.store(val)
+
+                timeout = 0
+
+            if count and self.collected:
+                self.collected(count)
+
+            return count
+
+        def store(self, val):
+            """Store an item we got from the queue. Returns how many items it counts for"""
+            if isinstance(val, _Chunk):
+                self.l.extend(val)
+                return len(val)
+
+            self.l.append(val)
+            return 1
+
+    class Vacuum(Collector, ThreadLoop):
+        # how long to wait for a worker that's reading the same queue
+        CONTENDED_TIMEOUT = 0.1
+
+        def __init__(self, q, l, collected=None, maxsize=0):
+            """Move items from queue 'q' into list 'l' in the background.
+
+            The thread blocks on the queue's file descriptor, so items are
+            moved as soon as they arrive and an idle vacuum doesn't wake up.
+
+            See Collector for the arguments.
+            """
+            WaitableQueue.Collector.__init__(self, q, l, collected, maxsize)
+            self._stopped = PipeEvent()
+
             def callback():
-                q.wait_notempty(0.1)
+                fds = [ self, self._stopped ]
+                if self.full():
+                    self.room.clear()
+
+                    # recheck in case room was made before we cleared
+                    if self.full():
+                        fds = [ self.room, self._stopped ]
+
+                try:
+                    readable = select.select(fds, [], [])[0]
+                except select.error, e:
+                    if e[0] != errno.EINTR:
+                        raise
+                    return True
 
-                while True:
-                    try:
-                        val = q.get(False)
-                        l.append(val)
+                if self._stopped in readable:
+                    # drain what arrived before we were stopped
+                    self.collect()
+                    return False
 
-                    except Empty:
-                        break
+                if self in readable:
+                    self.collect(self.CONTENDED_TIMEOUT)
+
+                return True
 
             ThreadLoop.__init__(self, callback)
 
-    def __init__(self, maxsize=0):
+        def stop(self):
+            self._stopped.set()
+            self.thread.stop()
+
+    def __init__(self, maxsize=0, shm_threshold=None):
         self.cond_empty = Condition()
         self.cond_notempty = Condition()
-        self._put_counter = Value('i', 0)
+
+        # waiters register under the condition's lock so put and get only
+        # pay for a notify when someone is waiting
+        self._waiting_empty = RawValue('i', 0)
+        self._waiting_notempty = RawValue('i', 0)
+
+        # a synchronized Value takes its lock for the read and again for
+        # the write of +=, and still isn't atomic. Take one lock instead.
+        self._put_counter = RawValue('i', 0)
+        self._put_counter_lock = Lock()
+
+        self.shm_threshold = shm_threshold
+        self.shm_prefix = "pylib-shm-%d-%d-" % (os.getpid(), id(self))
 
         Queue.__init__(self, maxsize)
 
+    def _share(self, obj):
+        if isinstance(obj, _Queued):
+            return _Queued(self._share(obj.input), obj.at)
+
+        if isinstance(obj, _Crashed):
+            return _Crashed(self._share(obj.input), obj.crashes)
+
+        def share(obj):
+            if isinstance(obj, SharedBuffer):
+                obj = str(obj)
+
+            if isinstance(obj, str) and len(obj) >= self.shm_threshold:
+                return shmbuffer.share(obj, self.shm_prefix)
+
+            if type(obj) is tuple:
+                return tuple([ share(o) for o in obj ])
+
+            return obj
+
+        if isinstance(obj, _Chunk):
+            return _Chunk([ share(o) for o in obj ])
+
+        if isinstance(obj, _Task):
+            return _Task(obj.id, share(obj.input), obj.future)
+
+        if isinstance(obj, _TaskResult):
+            return _TaskResult(obj.id, share(obj.retval), obj.exception)
+
+        return share(obj)
+
+    def _unshare(self, obj):
+        if isinstance(obj, (_Queued, _Crashed)):
+            obj.input = self._unshare(obj.input)
+            return obj
+
+        def unshare(obj):
+            if isinstance(obj, ShmHandle):
+                return obj.open()
+
+            if type(obj) is tuple:
+                return tuple([ unshare(o) for o in obj ])
+
+            return obj
+
+        if isinstance(obj, _Chunk):
+            return _Chunk([ unshare(o) for o in obj ])
+
+        if isinstance(obj, _Task):
+            obj.input = unshare(obj.input)
+            return obj
+
+        if isinstance(obj, _TaskResult):
+            obj.retval = unshare(obj.retval)
+            return obj
+
+        return unshare(obj)
+
+    def cleanup_shm(self):
+        """Free shared memory of items that were put but never got"""
+        shmbuffer.cleanup(self.shm_prefix)
+
     def put(self, obj, block=True, timeout=None):
+        if self.shm_threshold is not None:
+            obj = self._share(obj)
+
         Queue.put(self, obj, block, timeout)
-        self._put_counter.value += 1
+        self._put(1)
+
+    def put_now(self, obj, block=True, timeout=None):
+        """Like put(), but write the item into the pipe before returning
+        instead of leaving that to the feeder thread. So the item isn't
+        lost if the process dies without exiting normally (e.g., SIGKILL
+        or os._exit) right after. Blocks while the pipe is full.
+        """
+        if self.shm_threshold is not None:
+            obj = self._share(obj)
+
+        assert not self._closed
+        if not self._sem.acquire(block, timeout):
+            raise Full
+
+        # what the feeder thread does
+        self._wlock.acquire()
+        try:
+            self._writer.send(obj)
+        finally:
+            self._wlock.release()
 
-        if self.qsize() != 0:
-            self.cond_notempty.acquire()
+        self._put(1)
+
+    def put_many(self, objs, block=True, timeout=None):
+        """Put a batch of items. If a bounded queue stays full for 'timeout'
+        the items that fit are put and Full is raised with their number.
+        """
+        objs = list(objs)
+        if not objs:
+            return
+
+        if self.shm_threshold is not None:
+            objs = [ self._share(obj) for obj in objs ]
+
+        assert not self._closed
+
+        # like Queue.put, but taking the buffer lock once for the batch
+        if block and timeout is not None:
+            deadline = time.time() + timeout
+
+        count = 0
+        for obj in objs:
+            if block and timeout is not None:
+                timeout = max(deadline - time.time(), 0)
+
+            if not self._sem.acquire(block, timeout):
+                break
+            count += 1
+
+        if count:
+            self._notempty.acquire()
             try:
-                self.cond_notempty.notify_all()
+                if self._thread is None:
+                    self._start_thread()
+                self._buffer.extend(objs[:count])
+                self._notempty.notify()
             finally:
-                self.cond_notempty.release()
+                self._notempty.release()
+
+            self._put(count)
+
+        if count < len(objs):
+            raise Full(count)
+
+    def _put(self, count):
+        self._put_counter_lock.acquire()
+        try:
+            self._put_counter.value += count
+        finally:
+            self._put_counter_lock.release()
+
+        if self._waiting_notempty.value:
+            self._notify(self.cond_notempty)
 
     @property
     def put_counter(self):
         return self._put_counter.value
 
+    def fileno(self):
+        """File descriptor that is readable when the queue may have items
+        (another reader may get them first)"""
+        return self._reader.fileno()
+
     def get(self, block=True, timeout=None):
         ret = Queue.get(self, block, timeout)
-        if self.qsize() == 0:
-            self.cond_empty.acquire()
-            try:
-                self.cond_empty.notify_all()
-            finally:
-                self.cond_empty.release()
+        self._got()
+
+        if self.shm_threshold is not None:
+            ret = self._unshare(ret)
 
         return ret
 
+    def get_many(self, max_n, block=True, timeout=None):
+        """Get up to 'max_n' items. Blocks (like get) only for the first
+        item, then takes whatever else is already queued. Returns a list
+        that's empty if no item arrived in time.
+        """
+        # like Queue.get, but taking the reader lock once for the batch
+        if block and timeout is not None:
+            deadline = time.time() + timeout
+
+        if not self._rlock.acquire(block, timeout):
+            return []
+
+        rets = []
+        try:
+            if block and timeout is not None:
+                ready = self._poll(max(deadline - time.time(), 0))
+            elif block:
+                ready = True
+            else:
+                ready = self._poll()
+
+            while ready and len(rets) < max_n:
+                rets.append(self._recv())
+                self._sem.release()
+
+                ready = self._poll()
+        finally:
+            self._rlock.release()
+
+        if rets:
+            self._got()
+
+        if self.shm_threshold is not None:
+            rets = [ self._unshare(ret) for ret in rets ]
+
+        return rets
+
+    def _got(self):
+        if self._waiting_empty.value and self.qsize() == 0:
+            self._notify(self.cond_empty)
+
+    @staticmethod
+    def _notify(cond):
+        cond.acquire()
+        try:
+            cond.notify_all()
+        finally:
+            cond.release()
+
+    def _wait(self, cond, waiting, done, timeout):
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        cond.acquire()
+        waiting.value += 1
+        try:
+            while not done():
+                if timeout is None:
+                    cond.wait(self.WAIT_RECHECK)
+                    continue
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                cond.wait(min(remaining, self.WAIT_RECHECK))
+        finally:
+            waiting.value -= 1
+            cond.release()
+
     def wait_empty(self, timeout=None):
         """Wait for all items to be got"""
-        self.cond_empty.acquire()
+        self._wait(self.cond_empty, self._waiting_empty,
+                   lambda: self.qsize() == 0, timeout)
+
+    def wait_notempty(self, timeout=None):
+        """Wait for an item to be put"""
+        self._wait(self.cond_notempty, self._waiting_notempty,
+                   lambda: self.qsize() != 0, timeout)
+
+class ThreadWaitableQueue(ThreadQueue):
+    """In-process counterpart of WaitableQueue for threads. Items aren't pickled.
+
+    Emptiness is signalled through PipeEvents, so blocking gets and waits
+    wake up immediately instead of polling like threading.Condition does.
+    """
+    def __init__(self, maxsize=0):
+        ThreadQueue.__init__(self, maxsize)
+
+        self.put_counter = 0
+
+        self._empty = PipeEvent()
+        self._empty.set()
+        self._notempty = PipeEvent()
+
+    # _put and _get are called by Queue with self.mutex held
+
+    def _put(self, item):
+        ThreadQueue._put(self, item)
+        self.put_counter += 1
+
+        self._empty.clear()
+        self._notempty.set()
+
+    def _get(self):
+        item = ThreadQueue._get(self)
+        if not self._qsize():
+            self._notempty.clear()
+            self._empty.set()
+
+        return item
+
+    def get(self, block=True, timeout=None):
+        if not block:
+            return ThreadQueue.get(self, False)
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            try:
+                return ThreadQueue.get(self, False)
+            except Empty:
+                pass
+
+            if timeout is None:
+                self._notempty.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Empty
+
+                self._notempty.wait(remaining)
+
+    def put_now(self, obj, block=True, timeout=None):
+        """Same as put(): there's no feeder thread to lose items in"""
+        self.put(obj, block, timeout)
+
+    def put_many(self, objs, block=True, timeout=None):
+        """Put a batch of items (see WaitableQueue.put_many)"""
+        objs = list(objs)
+
+        if self.maxsize > 0:
+            # bounded: wait for room item by item
+            for count, obj in enumerate(objs):
+                try:
+                    self.put(obj, block, timeout)
+                except Full:
+                    raise Full(count)
+
+            return
+
+        if not objs:
+            return
+
+        self.mutex.acquire()
         try:
-            if self.qsize():
-                self.cond_empty.wait(timeout)
+            for obj in objs:
+                self._put(obj)
+
+            self.unfinished_tasks += len(objs)
+            self.not_empty.notify(len(objs))
         finally:
-            self.cond_empty.release()
+            self.mutex.release()
 
-    def wait_notempty(self, timeout=None):
+    def get_many(self, max_n, block=True, timeout=None):
+        """Get up to 'max_n' items (see WaitableQueue.get_many)"""
+        try:
+            rets = [ self.get(block, timeout) ]
+        except Empty:
+            return []
+
+        self.mutex.acquire()
+        try:
+            while len(rets) < max_n and self._qsize():
+                rets.append(self._get())
+
+            self.not_full.notify(len(rets) - 1)
+        finally:
+            self.mutex.release()
+
+        return rets
+
+    def fileno(self):
+        """File descriptor that is readable while the queue has items"""
+        return self._notempty.fileno()
+
+    def wait_empty(self, timeout=None):
         """Wait for all items to be got"""
-        self.cond_notempty.acquire()
+        self._empty.wait(timeout)
+
+    def wait_notempty(self, timeout=None):
+        """Wait for an item to be put"""
+        self._notempty.wait(timeout)
+
+class StealingQueues:
+    """Per-worker input queues that idle workers steal from.
+
+    Instead of every worker contending on a single queue (and its locks),
+    each worker slot has its own queue. Items are put round-robin and a
+    worker gets from its own queue first. If that's empty it tries to
+    steal from the other slots. An idle worker blocks on the file
+    descriptors of all the queues at once, so it wakes up as soon as any
+    of them has items instead of polling the other slots.
+
+    Supports the parts of the queue interface Parallelize uses: put(),
+    qsize() and the per-slot views returned by local().
+    """
+    class Local:
+        """View of the queues for the worker in one slot"""
+        def __init__(self, queues, slot):
+            self.queue = queues[slot]
+
+            # steal in a different order from each slot to spread contention
+            self.others = queues[slot + 1:] + queues[:slot]
+
+            # created on first use, in the worker
+            self._poller = None
+
+        def put(self, obj):
+            self.queue.put(obj)
+
+        def fileno(self):
+            return self.queue.fileno()
+
+        def _ready(self, timeout):
+            """Return the queues that may have items, own queue first, waiting
+            up to 'timeout' (None is forever) for any"""
+            if self._poller is None:
+                # unlike select, poll isn't limited to FD_SETSIZE descriptors
+                self._poller = select.poll()
+                self._order = {}
+                for i, queue in enumerate([ self.queue ] + self.others):
+                    self._poller.register(queue.fileno(), select.POLLIN)
+                    self._order[queue.fileno()] = (i, queue)
+
+            if timeout is not None:
+                timeout = max(int(math.ceil(timeout * 1000)), 0)
+
+            try:
+                events = self._poller.poll(timeout)
+            except select.error, e:
+                if e[0] != errno.EINTR:
+                    raise
+                events = []
+
+            ready = [ self._order[fd] for fd, event in events ]
+            ready.sort()
+            return [ queue for i, queue in ready ]
+
+        def get(self, block=True, timeout=None):
+            if block and timeout is not None:
+                deadline = time.time() + timeout
+
+            while True:
+                if not block:
+                    remaining = 0
+                elif timeout is None:
+                    remaining = None
+                else:
+                    remaining = max(deadline - time.time(), 0)
+
+                # only the queues that have items are worth locking
+                for queue in self._ready(remaining):
+                    try:
+                        return queue.get(False)
+                    except Empty:
+                        pass
+
+                if remaining == 0:
+                    raise Empty
+
+    def __init__(self, slots, queue_class=WaitableQueue, *queue_args):
+        self.queues = [ queue_class(0, *queue_args) for i in range(slots) ]
+        self._next_slot = itertools.cycle(range(slots))
+
+    def local(self, slot):
+        return self.Local(self.queues, slot)
+
+    def put(self, obj, slot=None):
+        if slot is None:
+            slot = self._next_slot.next()
+        self.queues[slot].put(obj)
+
+    def qsize(self):
+        return sum([ queue.qsize() for queue in self.queues ])
+
+def _rss():
+    """Return the current resident set size of this process in bytes"""
+    try:
+        pages = int(open("/proc/self/statm").read().split()[1])
+    except IOError:
+        # no /proc: peak RSS is the best we have
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+class _LocalValue:
+    """Stand-in for RawValue when sharing within a process"""
+    def __init__(self, typecode, value):
+        self.value = value
+
+def _local_array(typecode, size):
+    """Stand-in for RawArray when sharing within a process"""
+    return [ 0 ] * size
+
+class _Results:
+    """List of return values that can also be consumed from the front.
+
+    Unlike a deque, indexing (and so the indexed results iterator) is O(1)
+    and slicing works. Consumed values are released in batches.
+    """
+    # release consumed values once there are at least this many and they
+    # make up half the list
+    COMPACT = 1024
+
+    def __init__(self):
+        # (values, index of the first unconsumed one). Replaced as a whole,
+        # so readers get a consistent pair without locking. Writers lock so
+        # a value appended while compacting isn't lost.
+        self._state = ([], 0)
+        self._lock = threading.Lock()
+
+    def append(self, val):
+        self._lock.acquire()
+        try:
+            self._state[0].append(val)
+        finally:
+            self._lock.release()
+
+    def extend(self, vals):
+        self._lock.acquire()
+        try:
+            self._state[0].extend(vals)
+        finally:
+            self._lock.release()
+
+    def popleft(self):
+        self._lock.acquire()
         try:
-            if self.qsize() == 0:
-                self.cond_notempty.wait(timeout)
+            l, head = self._state
+            if head >= len(l):
+                raise IndexError("pop from empty results")
+
+            val = l[head]
+            l[head] = None
+            head += 1
+
+            if head >= self.COMPACT and head * 2 >= len(l):
+                self._state = (l[head:], 0)
+            else:
+                self._state = (l, head)
         finally:
-            self.cond_notempty.release()
+            self._lock.release()
+
+        return val
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._state = ([], 0)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        l, head = self._state
+        return len(l) - head
+
+    def __getitem__(self, key):
+        l, head = self._state
+        if isinstance(key, slice):
+            return l[head:][key]
+
+        if key < 0:
+            key += len(l) - head
+            if key < 0:
+                raise IndexError("results index out of range")
+
+        return l[head + key]
+
+    def __iter__(self):
+        l, head = self._state
+        return iter(l[head:])
+
+class _Counters:
+    """Call statistics of a worker, in memory shared with the parent.
+
+    Latency histograms count calls by the first bucket in BUCKETS (upper
+    bounds in seconds) they fit in, with an extra last bucket for longer.
+    """
+    BUCKETS = [ 0.0001 * 2 ** i for i in range(22) ] # 100us to ~3.5 minutes
+
+    def __init__(self, new_value=_LocalValue, new_array=_local_array):
+        self.calls = new_value('l', 0)
+        self.retries = new_value('l', 0)
+        self.busy = new_value('d', 0)
+        self.wait_hist = new_array('l', len(self.BUCKETS) + 1)
+        self.run_hist = new_array('l', len(self.BUCKETS) + 1)
+
+    def ran(self, elapsed):
+        self.calls.value += 1
+        self.busy.value += elapsed
+        self.run_hist[bisect.bisect_left(self.BUCKETS, elapsed)] += 1
+
+    def waited(self, elapsed, count=1):
+        self.wait_hist[bisect.bisect_left(self.BUCKETS, elapsed)] += count
+
+    def retried(self, count=1):
+        self.retries.value += count
+
+    def add(self, other):
+        """Add the counts of 'other' to ours"""
+        self.calls.value += other.calls.value
+        self.retries.value += other.retries.value
+        self.busy.value += other.busy.value
+        for i in range(len(self.BUCKETS) + 1):
+            self.wait_hist[i] += other.wait_hist[i]
+            self.run_hist[i] += other.run_hist[i]
 
 class Deferred:
     def __init__(self, callable, *args, **kwargs):
@@ -92,64 +878,604 @@ class Deferred:
     def __call__(self):
         return self.callable(*self.args, **self.kwargs)
 
-class Parallelize:
-    """
-    Usage:
+class Future:
+    """Lightweight handle on the return value of a Parallelize.submit() call"""
 
-    1) You pass a sequence of callables to Parallelize. In the most simple
-       usage case these will be functions, but they can also be callable
-       instances.
+    class Timeout(Exception):
+        pass
 
-    2) You get back a Parallelize instance which is another callable, which
-       you call with input arguments to queue a parallelized call in one of
-       the underlying processes.
+    def __init__(self):
+        self._event = threading.Event()
+        self._retval = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """True if the call finished or failed"""
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """Wait up to 'timeout' seconds for the call to finish. Returns
+        True if it did"""
+        if timeout is None or self.done():
+            # without a timeout threading.Event blocks instead of polling
+            return self._event.wait()
+
+        # with a timeout it polls in Python 2, so wait on a pipe instead.
+        # Only while waiting, so pending futures don't hold file descriptors
+        event = PipeEvent()
+        callback = lambda future: event.set()
+        self.add_done_callback(callback)
+
+        finished = event.wait(timeout)
+        if not finished:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError: # we raced with _finish()
+                pass
 
-    3) The .wait() method waits for all queued execution to finish.
+        return finished or self.done()
 
-    4) The .stop() method stops parallel execution.
+    def result(self, timeout=None):
+        """Wait up to 'timeout' seconds for the return value.
 
-       Returns an empty array if you call it after wait() has completed.
+        Raises the call's exception if it failed, or Future.Timeout
+        """
+        if not self.wait(timeout):
+            raise self.Timeout("no result within %s seconds" % timeout)
 
-       Returns aborted inputs if you call it mid-execution (e.g., handling an
-       exception such as Ctrl-C)
+        if self._exception is not None:
+            raise self._exception
 
-    5) The .results is an iterator that iterates over return values from workers.
+        return self._retval
 
-       A background thread collects return values in real-time as soon as the
-       underlying functions in various processes finish executing and return
-       values.
+    def exception(self, timeout=None):
+        """Wait up to 'timeout' seconds and return the call's exception (or None)"""
+        if not self.wait(timeout):
+            raise self.Timeout("no result within %s seconds" % timeout)
 
-       After .wait() the number of return values will be the same size as the number of calls
-       to the Parallelize instance, unless parallelize was aborted.
+        return self._exception
 
-    Note that you have to call either wait or stop or Parallelize to collect results.
+    def add_done_callback(self, callback):
+        """Call callback(future) when the future is done (right now if it already is)"""
+        if self.done():
+            callback(self)
+        else:
+            self._callbacks.append(callback)
 
-    Exception handling:
+            # we may have raced with _finish()
+            if self.done() and callback in self._callbacks:
+                self._callbacks.remove(callback)
+                callback(self)
 
-        An uncaught exception inside a worker kills the worker, resubmits the
-        input into the queue where it will be picked up by another worker.
+    def _finish(self, retval=None, exception=None):
+        if self.done():
+            return
+
+        self._retval = retval
+        self._exception = exception
+        self._event.set()
+
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
 
+def as_completed(futures, timeout=None):
+    """Yield 'futures' as they complete.
+
+    Raises Future.Timeout if they don't all complete within 'timeout' seconds
     """
-    class Error(Exception):
-        pass
+    pending = set(futures)
+    finished = deque()
+    event = PipeEvent()
 
-    class Worker(Process):
-        class Retry(Exception):
-            pass
+    def callback(future):
+        finished.append(future)
+        event.set()
 
-        class Terminated(Exception):
-            pass
+    for future in list(pending):
+        future.add_done_callback(callback)
 
-        @classmethod
-        def worker(cls, initialized, done, idle, q_input, q_output, executor):
-            def raise_exception(s, f):
-                signal.signal(s, signal.SIG_IGN)
-                raise cls.Terminated
+    if timeout is not None:
+        deadline = time.time() + timeout
 
-            signal.signal(signal.SIGTERM, raise_exception)
-            signal.signal(signal.SIGINT, raise_exception)
+    while pending:
+        while finished:
+            future = finished.popleft()
+            if future in pending:
+                pending.remove(future)
+                yield future
 
-            idle.clear()
+        if not pending:
+            break
+
+        event.clear()
+        if finished:
+            continue
+
+        if timeout is None:
+            event.wait()
+        else:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not event.wait(remaining):
+                if not finished:
+                    raise Future.Timeout("%d futures unfinished after %s seconds" %
+                                         (len(pending), timeout))
+
+def _send_bytes(sock, data):
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+def _send_message(sock, message):
+    _send_bytes(sock, cPickle.dumps(message, 2))
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError("connection closed")
+
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return "".join(chunks)
+
+def _recv_bytes(sock, maxsize=None):
+    size, = struct.unpack("!I", _recv_exactly(sock, 4))
+    if maxsize is not None and size > maxsize:
+        raise AuthenticationError("message too long")
+
+    return _recv_exactly(sock, size)
+
+def _recv_message(sock):
+    return cPickle.loads(_recv_bytes(sock))
+
+_CHALLENGE_SIZE = 32
+_WELCOME = "#WELCOME#"
+_FAILURE = "#FAILURE#"
+
+def _deliver_challenge(sock, authkey):
+    challenge = os.urandom(_CHALLENGE_SIZE)
+    _send_bytes(sock, challenge)
+
+    digest = hmac.new(authkey, challenge, hashlib.sha256).digest()
+    if not hmac.compare_digest(_recv_bytes(sock, len(digest)), digest):
+        _send_bytes(sock, _FAILURE)
+        raise AuthenticationError("digest received was wrong")
+
+    _send_bytes(sock, _WELCOME)
+
+def _answer_challenge(sock, authkey):
+    challenge = _recv_bytes(sock, _CHALLENGE_SIZE)
+    _send_bytes(sock, hmac.new(authkey, challenge, hashlib.sha256).digest())
+
+    if _recv_bytes(sock, len(_WELCOME)) != _WELCOME:
+        raise AuthenticationError("digest sent was rejected")
+
+def _authenticate(sock, authkey, server):
+    """Prove to each other that both ends of 'sock' have 'authkey' (like
+    multiprocessing.connection does), before either unpickles anything
+    the other sent. Raises AuthenticationError if they don't."""
+    if server:
+        _deliver_challenge(sock, authkey)
+        _answer_challenge(sock, authkey)
+    else:
+        _answer_challenge(sock, authkey)
+        _deliver_challenge(sock, authkey)
+
+class Journal:
+    """Append-only on-disk log of submitted and completed calls.
+
+    Each record is a line: "S <id> <base64 pickled input>" when a call is
+    submitted and "C <id>" when it completes (or fails for good). Records
+    are buffered in memory and pickled, written and fsync'd in batches by
+    a background thread every SYNC_INTERVAL seconds, so journaling doesn't
+    add serialization or disk I/O to each call. Don't modify inputs after
+    submitting them. The price is that calls submitted or
+    completed within the last SYNC_INTERVAL seconds before a crash may be
+    lost or replayed. Call sync() to make sure everything is on disk.
+
+    Opening an existing journal reads the calls that were submitted but
+    never completed into .unfinished as (id, input) tuples, then compacts
+    the journal down to just those.
+    """
+    SYNC_INTERVAL = 0.5
+
+    def __init__(self, path):
+        self.path = path
+
+        self.unfinished = []
+        self.next_id = 0
+        if os.path.exists(path):
+            self.unfinished, self.next_id = self._read(path)
+
+        self._buf = []
+        self._lock = threading.Lock()
+
+        # rewrite atomically so a crash while compacting loses nothing
+        tmp = path + ".tmp"
+        fh = file(tmp, "w")
+        for id, input in self.unfinished:
+            fh.write(self._submit_record(id, input))
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        os.rename(tmp, path)
+
+        self._fh = file(path, "a")
+
+        def flusher():
+            time.sleep(self.SYNC_INTERVAL)
+            self.sync()
+
+        self._flusher = ThreadLoop(flusher)
+
+    @staticmethod
+    def _submit_record(id, input):
+        return "S %d %s" % (id, binascii.b2a_base64(cPickle.dumps(input, 2)))
+
+    @staticmethod
+    def _read(path):
+        submitted = {}
+        order = []
+        next_id = 0
+
+        for line in file(path):
+            # a crash may have torn the last record
+            if not line.endswith("\n"):
+                break
+
+            try:
+                fields = line.split()
+                id = int(fields[1])
+                if fields[0] == "S":
+                    submitted[id] = cPickle.loads(binascii.a2b_base64(fields[2]))
+                    order.append(id)
+                elif fields[0] == "C":
+                    submitted.pop(id, None)
+            except (IndexError, ValueError, binascii.Error, cPickle.UnpicklingError):
+                continue
+
+            next_id = max(next_id, id + 1)
+
+        unfinished = [ (id, submitted[id]) for id in order if id in submitted ]
+        return unfinished, next_id
+
+    def submitted(self, id, input):
+        self._buf.append((id, input))
+
+    def completed(self, id):
+        self._buf.append((id,))
+
+    def sync(self):
+        """Write and fsync buffered records"""
+        self._lock.acquire()
+        try:
+            if not self._buf or self._fh.closed:
+                return
+
+            buf, self._buf = self._buf, []
+
+            records = []
+            for record in buf:
+                if len(record) == 2:
+                    records.append(self._submit_record(*record))
+                else:
+                    records.append("C %d\n" % record)
+
+            self._fh.write("".join(records))
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+        finally:
+            self._lock.release()
+
+    def close(self):
+        if self._fh.closed:
+            return
+
+        self._flusher.stop()
+        self.sync()
+        self._fh.close()
+
+class Parallelize:
+    """
+    Usage:
+
+    1) You pass a sequence of callables to Parallelize. In the most simple
+       usage case these will be functions, but they can also be callable
+       instances.
+
+    2) You get back a Parallelize instance which is another callable, which
+       you call with input arguments to queue a parallelized call in one of
+       the underlying processes.
+
+    3) The .wait() method waits for all queued execution to finish.
+
+       Every call is counted as in flight until its return value has been
+       collected, so wait() returns as soon as the last result lands.
+
+    4) The .stop() method stops parallel execution.
+
+       Returns an empty array if you call it after wait() has completed.
+
+       Returns aborted inputs if you call it mid-execution (e.g., handling an
+       exception such as Ctrl-C)
+
+    5) The .results is an iterator that iterates over return values from workers.
+
+       A background thread collects return values in real-time as soon as the
+       underlying functions in various processes finish executing and return
+       values.
+
+       After .wait() the number of return values will be the same size as the number of calls
+       to the Parallelize instance, unless parallelize was aborted.
+
+       .consume_results() returns an iterator that releases return values
+       as it yields them, so a long-running pool doesn't accumulate them.
+       Like .results it stops when nothing is left in flight and can be
+       iterated again after more calls.
+
+       With results_maxsize set, collection pauses while that many return
+       values are waiting to be consumed, and workers block on returning
+       more once the output queue fills up. Note that wait() can't finish
+       until the remaining return values fit, so consume from another
+       thread (or iterate instead of waiting).
+
+    6) With chunksize > 1 calls are buffered and sent to workers in chunks of
+       up to chunksize inputs, and return values come back in chunks too.
+       This amortizes queue overhead over many small inputs. A partial chunk
+       is sent when you wait for or iterate over results. Return values are
+       unbatched so the results of a chunk keep the order of its inputs.
+
+    7) The .submit() method queues a call like calling the instance does,
+       but returns a Future for that call's return value. The return value
+       is delivered to the Future only, not to .results. Use
+       as_completed() to handle a group of futures as they finish.
+
+       If the pool is stopped before a call finishes its Future fails with
+       Parallelize.Error.
+
+    8) With task_timeout set, a worker that spends longer than task_timeout
+       seconds on a call is sent SIGTERM, then SIGKILL if it doesn't exit
+       within TERMINATE_GRACE seconds, and is replaced by a fresh worker
+       with the same executor. The call isn't retried: its Future fails
+       with Parallelize.TaskTimeout, or for plain calls (input, exception)
+       is appended to .failed. task_timeout doesn't support chunking.
+
+    9) With max_tasks_per_worker and/or max_rss_per_worker (bytes of RSS
+       growth since the worker started making calls) set, a worker that reaches the limit finishes its current
+       call, returns its result and exits, and is replaced by a fresh
+       worker with the same executor (a Deferred executor is constructed
+       again). This caps memory growth in executors that build caches.
+
+    10) With max_workers set the pool autoscales: it starts min_workers
+        workers (default: one per executor) and the executors serve as
+        templates for new workers, used round-robin. Whenever queued input
+        would keep every worker busy, more workers are started, up to
+        max_workers. Workers idle for more than idle_timeout seconds are
+        stopped until only min_workers are left.
+
+    11) With backend="thread" workers are threads of the calling process
+        and inputs and return values are passed through in-process queues
+        without pickling. This suits executors that mostly wait on I/O or
+        subprocesses. Threads can't be killed, so task_timeout and
+        max_rss_per_worker aren't supported and stop() waits for calls in
+        progress to finish.
+
+    12) For select/poll or an event loop, watch .fileno(): it's readable
+        while the .ready event is set, which happens whenever return values
+        are collected, calls complete or fail, or nothing is left in flight.
+        Clear .ready before handling what's ready. AsyncParallelize builds
+        an asyncio style interface on top of this.
+
+    13) With shm_threshold set, string arguments and return values of at
+        least that many bytes skip pickling and the queue pipes: they're
+        written to a shared memory segment and only a small handle is
+        queued. The receiving side (executor or .results) gets a zero-copy
+        shmbuffer.SharedBuffer instead of a str; use str() on it if you
+        need a copy. See shmbuffer for lifetime rules. Segments left over
+        from a stopped pool are removed by stop(). Ignored by the thread
+        backend, which doesn't copy anything anyway.
+
+    14) With scheduler="steal" each worker slot gets its own input queue
+        instead of all workers contending on one (see StealingQueues).
+        Inputs are spread round-robin and idle workers steal from other
+        workers' queues. This helps many workers running small calls.
+        Retried inputs go back to the retrying worker's queue where others
+        can steal them, and stop() still returns every unprocessed input.
+
+    15) With priorities=True calls are scheduled by priority instead of
+        FIFO. Pass priority=n to __call__ or submit (lower runs first,
+        default 0) and optionally deadline=seconds. Queued calls are held
+        in a heap in the parent and only as many as there are workers are
+        handed to the input queue at a time, so urgent calls don't wait
+        behind a backlog. To keep low priority work from starving, a call's
+        priority is worth 'aging' seconds of waiting per level: a call at
+        priority 2 runs after a call at priority 0 only if it was submitted
+        less than 2 * aging seconds earlier. A call with a deadline is
+        scheduled no later than its deadline, and fails with
+        DeadlineExceeded if it can't be started in time. See wait_stats().
+
+    16) stats() returns counts, queue depth, latency histograms and per
+        worker utilization, and stats_json() the same as JSON. They're
+        collected all the time at the cost of a few clock reads per call.
+
+    17) With journal=path, submitted and completed calls are logged to an
+        on-disk Journal. If the process dies, a new Parallelize with the
+        same journal resubmits the calls that never completed, and their
+        return values go into .results. Inputs aborted by stop() stay in
+        the journal too. Calls that fail for good (timeouts, poison tasks)
+        count as completed. Inputs must be picklable and chunksize must
+        be 1.
+
+    18) placement sets the CPU affinity of workers when they start, before
+        Deferred executors are initialized: "core" pins each worker to its
+        own CPU, "numa" spreads workers across NUMA nodes and lets each run
+        on any CPU of its node, and "inherit" keeps workers on the CPUs the
+        parent may run on (its cpuset). See affinity.placements().
+
+    19) Workers can run on other hosts: attach a Coordinator to the pool
+        and run run_agent() with the executor on each host. Agents pull
+        inputs in batches over TCP or a Unix socket, run them in a local
+        pool of their own (so Retry works as usual) and stream return
+        values back (and the exceptions of submitted calls, as for local
+        workers). stop() makes agents abort and hand back what they
+        haven't done. Inputs of agents that disconnect are resubmitted.
+        An agent disconnects once all its workers have died, or one dies
+        without raising (e.g., it's killed), losing its call.
+        A pool can mix local and remote workers or have only remote ones
+        (Parallelize([])), in which case wait() waits for agents while the
+        coordinator accepts them.
+
+        Agents and the coordinator prove they share an authkey before they
+        exchange anything, but inputs and return values are sent as plain
+        pickles (unpickling runs arbitrary code), so use them only on a
+        trusted network.
+
+    Note that you have to call either wait or stop or Parallelize to collect results.
+
+    Exception handling:
+
+        An uncaught exception inside a worker kills the worker, resubmits the
+        input into the queue where it will be picked up by another worker.
+
+        Except for calls made with submit(): their exception is returned
+        through the Future (as an Error with the traceback if it can't be
+        pickled) and the worker carries on. If no worker is left to make
+        a submitted call, wait() fails its Future with Error.
+
+        A worker process that dies without raising (e.g., it's killed by a
+        signal or the OOM killer, or calls os._exit) can't hand back the
+        input it was working on. Its calls count as failed and, if they
+        were submitted, their Futures fail with Error.
+
+        With max_retries set, an input is resubmitted at most that many
+        times. An input that keeps crashing workers (a poison task) then
+        goes into the .dead_letters list as an (input, traceback) tuple,
+        and if it was submitted (so its call killed the worker instead of
+        raising), its Future fails with PoisonTask. Dead
+        workers are replaced, so a poison task costs max_retries + 1
+        crashes instead of every worker in the pool.
+
+    """
+    class Error(Exception):
+        pass
+
+    class TaskTimeout(Error):
+        pass
+
+    class DeadlineExceeded(Error):
+        pass
+
+    class PoisonTask(Error):
+        pass
+
+    # seconds a timed out worker gets to exit after SIGTERM before SIGKILL
+    TERMINATE_GRACE = 1.0
+
+    class _WorkerBase(object):
+        """Logic shared by process and thread workers"""
+        class Retry(Exception):
+            pass
+
+        class Terminated(Exception):
+            pass
+
+        @staticmethod
+        def _call_exception():
+            """Return the exception being handled, or its formatted traceback
+            if it doesn't survive pickling (see ResultsVacuum)"""
+            exception = sys.exc_info()[1]
+            formatted = traceback.format_exc()
+            try:
+                cPickle.loads(cPickle.dumps(exception, 2))
+            except Exception:
+                return formatted
+
+            return exception
+
+        @staticmethod
+        def _execute(executor, input):
+            if isinstance(input, tuple):
+                return executor(*input)
+            else:
+                return executor(input)
+
+        @classmethod
+        def _execute_chunk(cls, executor, chunk, q_input, q_output,
+                           counters=None, max_retries=None):
+            retvals = _Chunk()
+            retries = _Chunk()
+
+            i = 0
+            try:
+                for i, input in enumerate(chunk):
+                    started = time.time()
+                    try:
+                        retvals.append(cls._execute(executor, input))
+                    except cls.Retry:
+                        retries.append(input)
+                        continue
+
+                    if counters:
+                        counters.ran(time.time() - started)
+
+            except: # uncaught exceptions destroy worker
+                retries.extend(chunk[i + 1:])
+                cls._resubmit(chunk[i], 0, max_retries, q_input, q_output, counters)
+                raise
+
+            finally:
+                if retvals:
+                    q_output.put_now(retvals)
+
+                if retries:
+                    q_input.put(retries)
+                    if counters:
+                        counters.retried(len(retries))
+
+        @classmethod
+        def _resubmit(cls, input, crashes, max_retries, q_input, q_output,
+                      counters=None):
+            """Put back an input whose call was interrupted by an exception.
+
+            With 'max_retries' set, an input whose call raised more often
+            than that goes to q_output as a dead letter instead.
+            """
+            if max_retries is not None and \
+               not isinstance(sys.exc_info()[1], cls.Terminated):
+                crashes += 1
+                if crashes > max_retries:
+                    q_output.put(_DeadLetter(input, traceback.format_exc()))
+                    return
+
+            if crashes:
+                input = _Crashed(input, crashes)
+
+            q_input.put(input)
+            if counters:
+                counters.retried()
+
+        @classmethod
+        def worker(cls, initialized, done, idle, q_input, q_output, executor,
+                   started=None, task=None, calls=None, timed_out=None,
+                   max_tasks=None, max_rss=None, retired=None, exited=None,
+                   counters=None, max_retries=None, cpus=None):
+            def raise_exception(s, f):
+                signal.signal(s, signal.SIG_IGN)
+                raise cls.Terminated
+
+            try:
+                signal.signal(signal.SIGTERM, raise_exception)
+                signal.signal(signal.SIGINT, raise_exception)
+            except ValueError: # not the main thread (thread backend)
+                pass
+
+            # before initializing so memory is allocated near our CPUs
+            if cpus:
+                affinity.setaffinity(cpus)
+
+            idle.clear()
             try:
                 if isinstance(executor, Deferred):
                     executor = executor()
@@ -165,298 +1491,2008 @@ class Parallelize:
             class UNDEFINED:
                 pass
 
+            def retire():
+                if max_tasks and tasks >= max_tasks:
+                    return True
+
+                # a forked worker starts out with the parent's RSS
+                if max_rss and tasks and _rss() - rss_started >= max_rss:
+                    return True
+
+                return False
+
+            if max_rss:
+                rss_started = _rss()
+
+            parent = os.getppid()
+            tasks = 0
             try:
                 while True:
                     if done.is_set():
                         return
 
+                    if retired is not None and retire():
+                        retired.set()
+                        exited.set()
+                        return
+
+                    if timed_out and timed_out.is_set():
+                        return
+
                     retval = UNDEFINED
                     try:
                         input = q_input.get(timeout=0.1)
                     except Empty:
+                        # don't outlive a parent that was killed
+                        if cls._exit_when_orphaned and os.getppid() != parent:
+                            q_output.cancel_join_thread()
+                            return
+                        continue
+
+                    idle.clear()
+                    call_started = time.time()
+
+                    if isinstance(input, _Queued):
+                        input, queued_at = input.input, input.at
+                        if counters:
+                            count = 1
+                            if isinstance(input, _Chunk):
+                                count = len(input)
+                            counters.waited(call_started - queued_at, count)
+
+                    crashes = 0
+                    if isinstance(input, _Crashed):
+                        input, crashes = input.input, input.crashes
+
+                    # let the parent know what we're working on and since when,
+                    # so it can account for the calls if we die without raising
+                    if started is not None:
+                        task.value = -1
+                        if isinstance(input, _Task):
+                            task.value = input.id
+                        calls.value = 1
+                        if isinstance(input, _Chunk):
+                            calls.value = len(input)
+                        started.value = call_started
+
+                    if isinstance(input, _Chunk):
+                        tasks += len(input)
+                        try:
+                            cls._execute_chunk(executor, input, q_input, q_output,
+                                               counters, max_retries)
+                        finally:
+                            if started is not None:
+                                started.value = 0
+                            idle.set()
+
+                        continue
+
+                    tasks += 1
+
+                    try:
+                        try:
+                            if isinstance(input, _Task):
+                                retval = _TaskResult(input.id,
+                                                     cls._execute(executor, input.input))
+                            else:
+                                retval = cls._execute(executor, input)
+                        except (cls.Retry, cls.Terminated):
+                            raise
+                        except Exception:
+                            if not (isinstance(input, _Task) and input.future):
+                                raise
+
+                            # the caller gets the exception from its Future
+                            retval = _TaskResult(input.id,
+                                                 exception=cls._call_exception())
+
+                        if counters:
+                            counters.ran(time.time() - call_started)
+
+                        q_output.put_now(retval)
+
+                    except cls.Retry:
+                        q_input.put(input)
+                        if counters:
+                            counters.retried()
+
+                    except: # uncaught exceptions destroy worker
+                        # the parent reports inputs that timed out
+                        if retval is UNDEFINED and \
+                           not (timed_out and timed_out.is_set()):
+                            cls._resubmit(input, crashes, max_retries,
+                                          q_input, q_output, counters)
+
+                        # let the supervisor replace us promptly
+                        if max_retries is not None and exited is not None:
+                            exited.set()
+
+                        raise
+
+                    finally:
+                        if started is not None and not timed_out.is_set():
+                            started.value = 0
+
+                        idle.set()
+
+            except cls.Terminated:
+                pass # just exit peacefully
+
+        def _init_state(self, q_input, q_output, executor,
+                        max_tasks=None, max_rss=None, exited=None, max_retries=None,
+                        cpus=None):
+            """Set up state shared with the worker and return arguments for worker()
+
+            'max_tasks', 'max_rss': retire after that many calls or once RSS
+                                    grew by that many bytes
+
+            'exited': Event shared with the parent that we set on retiring
+
+            'max_retries': how often an input may crash a worker (see
+                           Parallelize docstring)
+
+            'cpus': CPUs the worker sets its affinity to when it starts
+            """
+            self.initialized = self._new_event()
+            self.idle = self._new_event()
+            self.done = self._new_event()
+
+            self.idle.set()
+
+            # when the current call started (0 if idle), its task id (-1 if
+            # untracked) and how many inputs it has (more than one if chunked)
+            self.started = self._new_value('d', 0)
+            self.task = self._new_value('l', -1)
+            self.calls = self._new_value('l', 0)
+
+            # set by the parent's supervisor when it terminates the worker
+            self.timed_out = self._new_event()
+            self.timed_out_task = None
+            self.timed_out_at = None
+
+            # when the parent's autoscaler first saw the worker idle
+            self.idle_since = None
+
+            # set by the worker when it exits because it reached its limits
+            self.retired = None
+            if max_tasks or max_rss:
+                self.retired = self._new_event()
+
+            self.executor = executor
+            self.cpus = cpus
+
+            self.counters = _Counters(self._new_value, self._new_array)
+            self.created = time.time()
+
+            return (self.initialized, self.done, self.idle, q_input, q_output, executor,
+                    self.started, self.task, self.calls, self.timed_out,
+                    max_tasks, max_rss, self.retired, exited, self.counters,
+                    max_retries, cpus)
+
+        def is_retired(self):
+            return self.retired is not None and self.retired.is_set()
+
+        def is_busy(self):
+            return self.is_alive() and not self.idle.is_set()
+
+        def is_initialized(self):
+            return self.initialized.is_set()
+
+        def is_stopped(self):
+            return self.done.is_set()
+
+        def wait(self, timeout=None):
+            """wait until Worker is idle"""
+            return self.idle.wait(timeout)
+
+        def stop(self):
+            """let worker finish what it was doing and join"""
+            if not self.is_alive():
+                return
+
+            self.done.set()
+
+    class Worker(_WorkerBase, Process):
+        _new_event = staticmethod(Event)
+        _new_value = staticmethod(RawValue)
+        _new_array = staticmethod(RawArray)
+        _exit_when_orphaned = True
+
+        def __init__(self, q_input, q_output, executor,
+                     max_tasks=None, max_rss=None, exited=None, max_retries=None,
+                     cpus=None):
+            args = self._init_state(q_input, q_output, executor,
+                                    max_tasks, max_rss, exited, max_retries, cpus)
+            Process.__init__(self, target=self.worker, args=args)
+
+    class ThreadWorker(_WorkerBase, threading.Thread):
+        _new_event = staticmethod(threading.Event)
+        _new_value = staticmethod(_LocalValue)
+        _new_array = staticmethod(_local_array)
+        _exit_when_orphaned = False
+
+        def __init__(self, q_input, q_output, executor,
+                     max_tasks=None, max_rss=None, exited=None, max_retries=None,
+                     cpus=None):
+            args = self._init_state(q_input, q_output, executor,
+                                    max_tasks, max_rss, exited, max_retries, cpus)
+            threading.Thread.__init__(self, target=self.worker, args=args)
+            self.daemon = True
+
+        def terminate(self):
+            """threads can't be killed: stop() waits for the current call"""
+            pass
+
+    class RemoteWorker(ThreadWorker):
+        """Stand-in for a worker agent connected over a socket (see Coordinator).
+
+        A thread that hands inputs from the input queue to the agent as it
+        asks for them and puts the return values it streams back into the
+        output queue. Inputs the agent had when the connection is lost or
+        that it aborted on stop() go back into the input queue.
+        """
+        def __init__(self, q_input, q_output, conn, peer):
+            self._init_state(q_input, q_output, None)
+            threading.Thread.__init__(self, target=self._serve,
+                                      args=(conn, q_input, q_output))
+            self.daemon = True
+            self.name = "RemoteWorker-%s" % (peer,)
+
+            self.conn = conn
+            self.procs = None
+
+        def terminate(self):
+            """abandon the agent: inputs it has go back into the input queue"""
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+        @staticmethod
+        def _unpack(item):
+            """Return (_Task or None, input) pairs for an input queue item"""
+            if isinstance(item, _Queued):
+                item = item.input
+
+            if isinstance(item, _Crashed):
+                item = item.input
+
+            if isinstance(item, _Chunk):
+                return [ (None, input) for input in item ]
+
+            if isinstance(item, _Task):
+                return [ (item, item.input) ]
+
+            return [ (None, item) ]
+
+        def _serve(self, conn, q_input, q_output):
+            outstanding = {}
+            seqs = itertools.count()
+            credit = 0
+            stopping = False
+
+            def give_back():
+                for task, input in outstanding.values():
+                    if task is None:
+                        q_input.put(input)
+                    else:
+                        q_input.put(task)
+                outstanding.clear()
+
+            try:
+                try:
+                    message, self.procs = _recv_message(conn)
+                    self.initialized.set()
+
+                    q_fd = q_input.fileno()
+                    while True:
+                        if self.done.is_set() and not stopping:
+                            _send_message(conn, ("stop",))
+                            stopping = True
+
+                        fds = [ conn ]
+                        if credit and not stopping:
+                            fds.append(q_fd)
+
+                        readable = select.select(fds, [], [], 0.1)[0]
+
+                        if conn in readable:
+                            message = _recv_message(conn)
+
+                            if message[0] == "results":
+                                retvals = _Chunk()
+                                for result in message[1]:
+                                    task, input = outstanding.pop(result[0])
+                                    if task is None:
+                                        retvals.append(result[1])
+                                    else:
+                                        # (seq, retval, exception) if the
+                                        # agent caught the call's exception
+                                        q_output.put(_TaskResult(task.id, *result[1:]))
+                                    self.counters.ran(0)
+                                credit += len(message[1])
+
+                                if retvals:
+                                    q_output.put(retvals)
+
+                            elif message[0] == "pull":
+                                credit += message[1]
+
+                            elif message[0] == "aborted":
+                                self.counters.retried(len(message[1]))
+                                give_back()
+                                return
+
+                        if credit and not stopping:
+                            batch = []
+                            while len(batch) < credit:
+                                try:
+                                    item = q_input.get(False)
+                                except Empty:
+                                    break
+
+                                for task, input in self._unpack(item):
+                                    seq = seqs.next()
+                                    outstanding[seq] = (task, input)
+
+                                    # a Future gets the call's exception
+                                    catch = task is not None and task.future
+                                    batch.append((seq, input, catch))
+
+                            if batch:
+                                self.idle.clear()
+                                _send_message(conn, ("tasks", batch))
+                                credit -= min(credit, len(batch))
+
+                        if not outstanding:
+                            self.idle.set()
+
+                except (socket.error, EOFError, select.error):
+                    # connection lost
+                    give_back()
+
+            finally:
+                self.idle.set()
+                conn.close()
+
+    class ResultsVacuum(WaitableQueue.Vacuum):
+        """Vacuum that hands the results of submitted tasks to their futures.
+
+        'tasks' maps the ids of tracked calls without a future to their
+        inputs. Their return values go into the results list, and their
+        failures into 'failed' as (input, exception) tuples.
+
+        Dead letters go into 'dead_letters' as (input, traceback) tuples.
+
+        If 'journal' is set, tasks that finish are logged to it as completed.
+
+        A task is only counted the first time its result is stored.
+        """
+        def __init__(self, q, l, collected, maxsize, futures, tasks, failed,
+                     dead_letters, journal=None):
+            self.futures = futures
+            self.tasks = tasks
+            self.failed = failed
+            self.dead_letters = dead_letters
+            self.journal = journal
+            self.failures = 0
+            WaitableQueue.Vacuum.__init__(self, q, l, collected, maxsize)
+
+        def store(self, val):
+            if isinstance(val, _DeadLetter):
+                input = val.input
+                if isinstance(input, _Task):
+                    future = self.futures.pop(input.id, None)
+                    self.tasks.pop(input.id, None)
+                    if self.journal:
+                        self.journal.completed(input.id)
+                    if future:
+                        future._finish(exception=Parallelize.PoisonTask(
+                            "input crashed workers too often:\n" + val.traceback))
+                    input = input.input
+
+                self.dead_letters.append((input, val.traceback))
+                self.failures += 1
+                return 1
+
+            if not isinstance(val, _TaskResult):
+                return WaitableQueue.Vacuum.store(self, val)
+
+            future = self.futures.pop(val.id, None)
+            try:
+                input = self.tasks.pop(val.id)
+            except KeyError:
+                if not future:
+                    return 0
+
+            if val.exception is not None:
+                self.failures += 1
+
+                # a worker couldn't pickle the exception, only its traceback
+                if isinstance(val.exception, basestring):
+                    val.exception = Parallelize.Error("call raised an exception "
+                                                      "that can't be pickled:\n" +
+                                                      val.exception)
+
+            if self.journal:
+                self.journal.completed(val.id)
+
+            if future:
+                future._finish(val.retval, val.exception)
+            elif val.exception is not None:
+                self.failed.append((input, val.exception))
+            else:
+                self.l.append(val.retval)
+
+            return 1
+
+    class IterResults:
+        """Iterates over return values as they are collected.
+
+        If 'consume' is True, return values are released as they are yielded
+        instead of being kept around for indexing. Don't mix a consuming
+        iterator with indexed access to the same results.
+
+        Iterating blocks until the next return value is collected, without
+        using CPU. Only one thread should iterate over a pool's results at
+        a time.
+        """
+        def __init__(self, parent, consume=False):
+            self.parent = parent
+            self.consume = consume
+            self.yielded = 0
+
+        def __iter__(self):
+            if not self.consume:
+                self.yielded = 0
+            return self
+
+        def _available(self):
+            if self.consume:
+                return len(self.parent._results) > 0
+            return len(self.parent._results) > self.yielded
+
+        def next(self):
+            parent = self.parent
+
+            while True:
+                # IndexError: the next return value isn't collected yet
+                try:
+                    if self.consume:
+                        result = parent._results.popleft()
+                        parent._results_vacuum.room.set()
+                    else:
+                        result = parent._results[self.yielded]
+                    self.yielded += 1
+                    return result
+                except IndexError:
+                    pass
+
+                # clear before checking so we can't miss a wakeup
+                parent._arrived.clear()
+                if self._available():
+                    continue
+
+                # everything in flight has been collected
+                if parent.wait(block=False):
+                    if self._available():
                         continue
 
-                    idle.clear()
+                    raise StopIteration
+
+                parent._arrived.wait(parent.LIVENESS_INTERVAL)
+
+        def __len__(self):
+            return len(self.parent._results)
+
+        def __getitem__(self, key):
+            return self.parent._results[key]
+
+        def __repr__(self):
+            return repr(list(self.parent._results))
+
+    def __init__(self, executors, chunksize=1, results_maxsize=0, task_timeout=None,
+                 max_tasks_per_worker=None, max_rss_per_worker=None,
+                 min_workers=None, max_workers=None, idle_timeout=30,
+                 backend="process", shm_threshold=None, scheduler="shared",
+                 priorities=False, aging=10.0, max_retries=None, journal=None,
+                 placement=None):
+        # so __del__ can stop() a half-constructed instance
+        self.workers = []
+
+        # the WarmPool we're leased from, if any
+        self._lease = None
+
+        # accepts remote worker agents, if any
+        self.coordinator = None
+
+        for executor in executors:
+            if not callable(executor):
+                raise self.Error("executor %s is not callable" % `executor`)
+
+        if task_timeout is not None and chunksize > 1:
+            raise self.Error("task_timeout doesn't support chunksize > 1")
+
+        if journal is not None and chunksize > 1:
+            raise self.Error("journal doesn't support chunksize > 1")
+
+        if backend == "process":
+            queue_class = WaitableQueue
+            queue_args = (shm_threshold,)
+            self._worker_class = self.Worker
+
+        elif backend == "thread":
+            if task_timeout is not None or max_rss_per_worker:
+                raise self.Error("task_timeout and max_rss_per_worker need backend='process'")
+
+            queue_class = ThreadWaitableQueue
+            queue_args = ()
+            self._worker_class = self.ThreadWorker
+
+        else:
+            raise self.Error("unknown backend %s" % `backend`)
+
+        self.backend = backend
+
+        if scheduler not in ("shared", "steal"):
+            raise self.Error("unknown scheduler %s" % `scheduler`)
+
+        self.scheduler = scheduler
+
+        if min_workers is None:
+            min_workers = len(executors)
+
+        if max_workers is not None:
+            if not executors:
+                raise self.Error("autoscaling needs at least one executor")
+
+            if min_workers < 1 or min_workers > max_workers:
+                raise self.Error("need 1 <= min_workers <= max_workers (not %d, %d)" %
+                                 (min_workers, max_workers))
+
+        if scheduler == "steal":
+            q_input = StealingQueues(max_workers or len(executors),
+                                     queue_class, *queue_args)
+        else:
+            q_input = queue_class(0, *queue_args)
+        q_output = queue_class(results_maxsize, *queue_args)
+
+        self.q_input = q_input
+        self.q_output = q_output
+
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.max_rss_per_worker = max_rss_per_worker
+        self.max_retries = max_retries
+
+        # CPUs for new workers, used round-robin
+        self.placement = placement
+        self._placements = None
+        if placement is not None:
+            try:
+                self._placements = affinity.placements(placement,
+                                                       max_workers or len(executors))
+            except (affinity.Error, OSError), e:
+                raise self.Error("can't place workers: %s" % e)
+        self._next_placement = itertools.count()
+
+        # set by workers that retire so the supervisor replaces them promptly
+        self._supervisor_wakeup = Event()
+
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+
+        self._executors = executors
+        self._next_executor = itertools.cycle(range(len(executors)))
+
+        self.workers = []
+        if max_workers is None:
+            for executor in executors:
+                self.workers.append(self._new_worker(executor))
+        else:
+            for i in range(min_workers):
+                self.workers.append(self._new_worker(executors[self._next_executor.next()]))
+
+        self.size = len(executors)
+
+        self.chunksize = chunksize
+        self._pending = _Chunk()
+
+        # inputs submitted vs. return values collected. Retried inputs are
+        # resubmitted by workers directly and don't count twice.
+        self._counter_lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+
+        # serializes accounting for workers that died mid-call (see _lost)
+        self._lost_lock = threading.Lock()
+
+        # statistics of workers that are gone (see stats())
+        self._restarts = 0
+        self._gone_counters = _Counters()
+        self._depth_history = deque(maxlen=self.STATS_SAMPLES)
+        self._depth_sampled = 0
+        self._stamp_countdown = 1
+
+        # set whenever there is nothing in flight
+        self._idle = PipeEvent()
+        self._idle.set()
+
+        # created on demand for select/poll and event loop users
+        self._ready = None
+
+        # set whenever return values are collected, for results iterators
+        self._arrived = PipeEvent()
+
+        self._futures = {}
+        self._task_ids = itertools.count()
+
+        # inputs of calls in flight, kept so we can report them if they time out
+        # or miss their deadline
+        self._tasks = {}
+        self.failed = []
+        self.dead_letters = []
+
+        # calls waiting to be dispatched, by scheduling key (see docstring)
+        self.priorities = priorities
+        self.aging = aging
+        self._queued = []
+        self._queued_seq = itertools.count()
+        self._queued_lock = threading.Lock()
+
+        # priority -> [calls dispatched, total seconds queued, max seconds queued]
+        self._wait_stats = {}
+
+        self.journal = None
+        if journal is not None:
+            self.journal = Journal(journal)
+            self._task_ids = itertools.count(self.journal.next_id)
+
+        self._results = _Results()
+        self._results_vacuum = self.ResultsVacuum(q_output, self._results,
+                                                  self._collected,
+                                                  results_maxsize,
+                                                  self._futures,
+                                                  self._tasks,
+                                                  self.failed,
+                                                  self.dead_letters,
+                                                  self.journal)
+
+        self.results = self.IterResults(self)
+
+        self.task_timeout = task_timeout
+        self._supervisor = None
+        if task_timeout is not None or max_tasks_per_worker or max_rss_per_worker or \
+           max_workers is not None or max_retries is not None:
+            interval = 1.0
+            if task_timeout is not None:
+                interval = max(min(task_timeout / 10.0, 0.5), 0.01)
+
+            if max_workers is not None:
+                interval = min(interval, max(idle_timeout / 4.0, 0.01))
+
+            def supervise():
+                self._supervise()
+
+                self._supervisor_wakeup.wait(interval)
+                self._supervisor_wakeup.clear()
+
+            self._supervisor = ThreadLoop(supervise)
+
+        # resume calls a previous pool didn't finish
+        if self.journal:
+            for id, input in self.journal.unfinished:
+                self._tasks[id] = input
+                self._submit(_Task(id, input))
+
+    def _new_worker(self, executor, slot=None, cpus=None):
+        q_input = self.q_input
+        if self.scheduler == "steal":
+            if slot is None:
+                slot = self._free_slot()
+            q_input = self.q_input.local(slot)
+
+        if cpus is None and self._placements:
+            cpus = self._placements[self._next_placement.next() % len(self._placements)]
+
+        worker = self._worker_class(q_input, self.q_output, executor,
+                                    self.max_tasks_per_worker, self.max_rss_per_worker,
+                                    self._supervisor_wakeup, self.max_retries, cpus)
+        worker.slot = slot
+        worker.start()
+
+        return worker
+
+    def _free_slot(self):
+        """Return the input queue slot for a new worker"""
+        slots = len(self.q_input.queues)
+        used = [ worker.slot for worker in self.workers ]
+        for slot in range(slots):
+            if slot not in used:
+                return slot
+
+        # stopped workers that haven't exited yet still hold their slots
+        return len(self.workers) % slots
+
+    def _input_queues(self):
+        if self.scheduler == "steal":
+            return self.q_input.queues
+
+        return [ self.q_input ]
+
+    def consume_results(self):
+        """Return an iterator that releases return values as it yields them"""
+        return self.IterResults(self, consume=True)
+
+    @property
+    def ready(self):
+        """PipeEvent set when return values are collected, calls complete or
+        fail, or nothing is left in flight"""
+        if self._ready is None:
+            self._ready = PipeEvent()
+            self._ready.set()
+
+        return self._ready
+
+    def fileno(self):
+        """File descriptor that is readable while .ready is set"""
+        return self.ready.fileno()
+
+    def any_alive(self):
+        """Return True if any workers are alive, else False"""
+        for worker in self.workers:
+            if worker.is_alive():
+                return True
+
+        return False
+
+    # how often a blocking wait() rechecks that workers are still alive
+    LIVENESS_INTERVAL = 1.0
+
+    # queue depth is sampled at most every STATS_INTERVAL seconds and the
+    # last STATS_SAMPLES samples are kept
+    STATS_INTERVAL = 1.0
+    STATS_SAMPLES = 300
+
+    # wait latency is measured for one in WAIT_SAMPLE_RATE inputs
+    WAIT_SAMPLE_RATE = 16
+
+    def _collected(self, count):
+        self._counter_lock.acquire()
+        try:
+            self._completed += count
+            if self._completed >= self._submitted:
+                self._idle.set()
+        finally:
+            self._counter_lock.release()
+
+        self._arrived.set()
+        if self._ready is not None:
+            self._ready.set()
+
+        self._dispatch()
+        self._sample_depth()
+
+    def _submit(self, input, count=1, priority=0, deadline=None):
+        self._counter_lock.acquire()
+        try:
+            self._submitted += count
+            self._idle.clear()
+        finally:
+            self._counter_lock.release()
+
+        if self.priorities:
+            now = time.time()
+
+            key = now + priority * self.aging
+            if deadline is not None:
+                deadline = now + deadline
+                key = min(key, deadline)
+
+            self._queued_lock.acquire()
+            try:
+                heapq.heappush(self._queued,
+                               (key, self._queued_seq.next(),
+                                now, priority, deadline, input))
+            finally:
+                self._queued_lock.release()
+
+            self._dispatch()
+        else:
+            self.q_input.put(self._stamp(input, time.time()))
+            self._sample_depth()
+
+        # let the autoscaler react to a burst right away
+        if self.max_workers is not None and len(self.workers) < self.max_workers:
+            self._supervisor_wakeup.set()
+
+    def _dispatch(self):
+        """Hand queued calls to the input queue while it's shallower than
+        the number of workers"""
+        if not self._queued:
+            return
+
+        expired = []
+
+        self._queued_lock.acquire()
+        try:
+            room = max(len(self.workers), 1) - self.q_input.qsize()
+            now = time.time()
+            while self._queued and room > 0:
+                key, seq, queued_at, priority, deadline, input = \
+                        heapq.heappop(self._queued)
+
+                if deadline is not None and now > deadline:
+                    expired.append(input)
+                    continue
+
+                stats = self._wait_stats.setdefault(priority, [0, 0.0, 0.0])
+                waited = now - queued_at
+                stats[0] += 1
+                stats[1] += waited
+                stats[2] = max(stats[2], waited)
+
+                self.q_input.put(self._stamp(input, queued_at))
+                room -= 1
+        finally:
+            self._queued_lock.release()
+
+        for input in expired:
+            exception = self.DeadlineExceeded("call wasn't started before its deadline")
+            count = self._results_vacuum.store(_TaskResult(input.id, exception=exception))
+            if count:
+                self._collected(count)
+
+    def _queue_depth(self):
+        """Number of inputs waiting for a worker"""
+        return len(self._queued) + self.q_input.qsize()
+
+    def wait_stats(self):
+        """Return how long dispatched calls were queued, by priority.
+
+        Returns a dict mapping each priority to a dict with the keys
+        'count', 'mean' and 'max' (seconds). Only covers the time calls
+        wait for their turn with priorities=True.
+        """
+        stats = {}
+        for priority, (count, total, longest) in self._wait_stats.items():
+            stats[priority] = { 'count': count,
+                                'mean': total / count,
+                                'max': longest }
+
+        return stats
+
+    def flush(self):
+        """Send buffered inputs to workers as a partial chunk"""
+        if not self._pending:
+            return
+
+        chunk = self._pending
+        self._pending = _Chunk()
+
+        self._submit(chunk, len(chunk))
+
+    @property
+    def inflight(self):
+        """Number of inputs submitted whose return values haven't been collected"""
+        return self._submitted - self._completed
+
+    def _stamp(self, input, queued_at):
+        """Stamp every WAIT_SAMPLE_RATE'th input with when it was queued"""
+        self._stamp_countdown -= 1
+        if self._stamp_countdown > 0:
+            return input
+
+        self._stamp_countdown = self.WAIT_SAMPLE_RATE
+        return _Queued(input, queued_at)
+
+    def _sample_depth(self):
+        now = time.time()
+        if now - self._depth_sampled < self.STATS_INTERVAL:
+            return
+
+        self._depth_sampled = now
+        self._depth_history.append((now, self._queue_depth()))
+
+    def _gone(self, worker, restart=False):
+        """Keep the statistics of a worker that exited"""
+        self._gone_counters.add(worker.counters)
+        if restart:
+            self._restarts += 1
+
+    def stats(self):
+        """Return a dict of statistics about the pool.
+
+        'submitted', 'completed', 'inflight': calls so far (a chunk of
+            inputs counts each input)
+        'retried': inputs resubmitted after Retry or a worker crash
+        'failed': calls that failed (timeouts, missed deadlines, poison tasks)
+        'dead_letters': inputs that exhausted their retries
+        'restarts': workers replaced after retiring, timing out or dying
+        'queue_depth': inputs waiting for a worker
+        'queue_depth_history': recent (time, queue_depth) samples
+        'wait_latency', 'run_latency': histograms of seconds from submit to
+            start and from start to finish of calls. 'buckets' are upper
+            bounds, 'counts' has an extra last count for longer calls.
+            Wait latency is sampled from one in WAIT_SAMPLE_RATE inputs.
+        'workers': per worker 'calls', 'busy' seconds, 'busy_fraction' of
+            its 'uptime', and 'pid' (None for threads)
+
+        Statistics are counted as calls happen, so this is cheap and
+        can be called at any time, even after stop().
+        """
+        now = time.time()
+
+        totals = _Counters()
+        totals.add(self._gone_counters)
+
+        workers = []
+        for worker in self.workers:
+            counters = worker.counters
+            totals.add(counters)
+
+            uptime = now - worker.created
+            workers.append({ 'name': worker.name,
+                             'pid': getattr(worker, 'pid', None),
+                             'calls': counters.calls.value,
+                             'busy': counters.busy.value,
+                             'uptime': uptime,
+                             'busy_fraction': min(counters.busy.value / uptime, 1.0) })
+
+        def histogram(counts):
+            return { 'buckets': _Counters.BUCKETS,
+                     'counts': list(counts) }
+
+        return { 'submitted': self._submitted,
+                 'completed': self._completed,
+                 'inflight': self.inflight,
+                 'retried': totals.retries.value,
+                 'failed': self._results_vacuum.failures,
+                 'dead_letters': len(self.dead_letters),
+                 'restarts': self._restarts,
+                 'queue_depth': self._queue_depth(),
+                 'queue_depth_history': list(self._depth_history),
+                 'wait_latency': histogram(totals.wait_hist),
+                 'run_latency': histogram(totals.run_hist),
+                 'workers': workers }
+
+    def stats_json(self, **kws):
+        """Return stats() as JSON. Keyword arguments go to json.dumps"""
+        return json.dumps(self.stats(), **kws)
+
+    def _is_dead(self, worker):
+        """True if 'worker' died of an exception and should be replaced"""
+        if self.max_retries is None or isinstance(worker, self.RemoteWorker):
+            return False
+
+        return worker.is_initialized() and not worker.is_alive() and \
+               not worker.is_stopped() and not worker.is_retired() and \
+               not worker.timed_out.is_set()
+
+    def _supervise(self):
+        """replace retired and dead workers, terminate workers that
+        exceeded task_timeout and replace them"""
+        now = time.time()
+
+        for i, worker in enumerate(self.workers):
+            if worker.is_retired() or self._is_dead(worker):
+                worker.join()
+                self._lost(worker)
+                self._gone(worker, restart=True)
+                self.workers[i] = self._new_worker(worker.executor, worker.slot,
+                                                   worker.cpus)
+                continue
+
+            if worker.timed_out.is_set():
+                if worker.is_alive():
+                    if now - worker.timed_out_at > self.TERMINATE_GRACE:
+                        os.kill(worker.pid, signal.SIGKILL)
+                    continue
+
+                worker.join()
+                self._timed_out(worker)
+                self._gone(worker, restart=True)
+
+                self.workers[i] = self._new_worker(worker.executor, worker.slot,
+                                                   worker.cpus)
+                continue
+
+            if self.task_timeout is None:
+                continue
+
+            started = worker.started.value
+            if started and now - started > self.task_timeout and worker.is_alive():
+                worker.timed_out_task = worker.task.value
+                worker.timed_out_at = now
+                worker.timed_out.set()
+
+                os.kill(worker.pid, signal.SIGTERM)
+
+        if self.max_workers is not None:
+            self._autoscale(now)
+
+    def _autoscale(self, now):
+        workers = [ worker for worker in self.workers
+                    if worker.is_alive() and not worker.is_stopped() ]
+
+        idle = []
+        for worker in workers:
+            if worker.is_busy():
+                worker.idle_since = None
+            else:
+                if worker.idle_since is None:
+                    worker.idle_since = now
+                idle.append(worker)
+
+        busy = len(workers) - len(idle)
+        wanted = max(self.min_workers,
+                     min(self.max_workers, busy + self._queue_depth()))
+
+        for i in range(wanted - len(workers)):
+            executor = self._executors[self._next_executor.next()]
+            self.workers.append(self._new_worker(executor))
+
+        excess = len(workers) - wanted
+        for worker in idle:
+            if excess <= 0:
+                break
+
+            if now - worker.idle_since > self.idle_timeout:
+                worker.stop()
+                excess -= 1
+
+        # forget workers we stopped once they exit
+        for worker in self.workers:
+            if worker.is_stopped() and not worker.is_alive():
+                worker.join()
+                self._gone(worker)
+        self.workers = [ worker for worker in self.workers
+                         if worker.is_alive() or not worker.is_stopped() ]
+
+    def _lost(self, worker):
+        """Fail the calls of a process worker that died without raising
+        (e.g., killed by a signal or the OOM killer, or os._exit), which
+        it couldn't return or resubmit. Returns True if it had any."""
+        if not isinstance(worker, Parallelize.Worker) or \
+           worker.timed_out.is_set() or worker.is_alive():
+            return False
+
+        self._lost_lock.acquire()
+        try:
+            if not worker.started.value:
+                return False
+            worker.started.value = 0
+        finally:
+            self._lost_lock.release()
+
+        exception = self.Error("worker died during the call (exit code %s)" %
+                               worker.exitcode)
+
+        count = 0
+        if worker.task.value != -1:
+            count = self._results_vacuum.store(_TaskResult(worker.task.value,
+                                                           exception=exception))
+        if not count:
+            count = worker.calls.value
+            self._results_vacuum.failures += count
+
+        self._collected(count)
+        return True
+
+    def _timed_out(self, worker):
+        # the call finished after all
+        if not worker.started.value:
+            return
+
+        id = worker.task.value
+        if id == worker.timed_out_task:
+            exception = self.TaskTimeout("call exceeded task_timeout of %s seconds" %
+                                         self.task_timeout)
+
+            count = self._results_vacuum.store(_TaskResult(id, exception=exception))
+            if count:
+                self._collected(count)
+
+            return
+
+        # the worker moved on to another call before it was terminated
+        if id in self._tasks:
+            self.q_input.put(_Task(id, self._tasks[id], id in self._futures))
+
+    def _submit_task(self, input, future=None, priority=0, deadline=None):
+        id = self._task_ids.next()
+        if future:
+            self._futures[id] = future
+
+        if self.task_timeout is not None or deadline is not None or self.journal:
+            self._tasks[id] = input
+
+        if self.journal:
+            self.journal.submitted(id, input)
+
+        self._submit(_Task(id, input, future is not None), 1, priority, deadline)
+
+    def _replacing(self):
+        """True if the supervisor is about to replace a worker, or a
+        Coordinator is accepting agents"""
+        if self.coordinator is not None and self.coordinator.accepting:
+            return True
+
+        if not self._supervisor:
+            return False
+
+        for worker in self.workers:
+            if worker.is_retired() or worker.timed_out.is_set() or \
+               self._is_dead(worker):
+                return True
+
+        return False
+
+    def _stop_idle_workers(self, keepalive_spares):
+        idle_workers = [ worker for worker in self.workers
+                            if worker.is_alive() and \
+                            not worker.is_busy() and \
+                            not worker.is_stopped() ]
+
+        for worker in idle_workers[keepalive_spares:]:
+
+            # check is_busy() again just to make sure
+            if not worker.is_busy():
+                worker.stop()
+
+    def _wait_nonblock(self, keepalive=True, keepalive_spares=0):
+        self.flush()
+
+        self._dispatch()
+
+        if not keepalive and self._lease is None and self._queue_depth() == 0:
+            # input queue is empty and keepalive is False: shutdown idle workers
+            self._stop_idle_workers(keepalive_spares)
+
+        if self._idle.is_set():
+            return True
+
+        lost = False
+        for worker in self.workers:
+            if worker.started.value and self._lost(worker):
+                lost = True
+
+        if lost and self._idle.is_set():
+            return True
+
+        # nobody left to process what's in flight
+        if not self.any_alive() and not self._replacing():
+            self._fail_futures("no workers left to make the call")
+            return True
+
+        return False
+
+    def wait(self, keepalive=True, keepalive_spares=0, block=True):
+        """wait for all input to be processed by workers.
+
+        Returns True if finished (always True when block=True) else False
+
+        Arguments:
+
+        If keepalive=False: stop idle workers once there's nothing left to do.
+        If keepalive=False and keepalive_spares > 0: keep alive at least
+        keepalive_spares spare workers.
+
+        """
+
+        while True:
+
+            finished = self._wait_nonblock(keepalive, keepalive_spares)
+            if finished or not block:
+                return finished
+
+            self._idle.wait(self.LIVENESS_INTERVAL)
+
+    def stop(self, finish_timeout=None):
+        """Stop workers and return any unprocessed input values"""
+
+        if self._lease is not None:
+            return self._lease._release(self)
+
+        if self.coordinator is not None:
+            self.coordinator.close()
+
+        if not self.workers:
+            return
+
+        if self._supervisor:
+            self._supervisor.stop()
+            self._supervisor = None
+
+        aborted = self._take_queued()
+
+        # nobody may be consuming anymore so let workers flush their results
+        self._unbound_results()
+
+        # ignore SIGINT and SIGTERM for now (restore later)
+        sigint_handler = signal.getsignal(signal.SIGINT)
+        sigterm_handler = signal.getsignal(signal.SIGTERM)
+
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+        for worker in self.workers:
+            worker.stop()
+
+        inputs_vacuums = [ WaitableQueue.Vacuum(q_input, aborted)
+                           for q_input in self._input_queues() ]
+
+        started = time.time()
+
+        try:
+            while True:
+                if not self.any_alive():
+                    break
+
+                if finish_timeout is not None and (time.time() - started) > finish_timeout:
+                    break
+
+                time.sleep(0.1)
+
+            for worker in self.workers:
+                if worker.is_alive():
+                    worker.terminate()
+
+            for worker in self.workers:
+                if worker.is_alive():
+                    worker.join()
+
+                self._gone(worker)
+
+            self.workers = []
+        finally:
+            time.sleep(0.1)
+            for inputs_vacuum in inputs_vacuums:
+                inputs_vacuum.stop()
+
+        self._results_vacuum.stop()
+
+        aborted = self._unwrap(aborted)
+        self._fail_futures()
+        self._tasks.clear()
+
+        if self.journal:
+            self.journal.close()
+
+        if self.backend == "process":
+            for q_input in self._input_queues():
+                q_input.cleanup_shm()
+            self.q_output.cleanup_shm()
+
+        signal.signal(signal.SIGINT, sigint_handler)
+        signal.signal(signal.SIGTERM, sigterm_handler)
+
+        return aborted
+
+    def _take_queued(self):
+        """Take back inputs that haven't been sent to workers yet"""
+        taken = list(self._pending)
+        self._pending = _Chunk()
+
+        self._queued_lock.acquire()
+        try:
+            for queued in sorted(self._queued):
+                input = queued[-1]
+                if isinstance(input, _Chunk):
+                    taken.extend(input)
+                else:
+                    taken.append(input)
+            self._queued = []
+        finally:
+            self._queued_lock.release()
+
+        return taken
+
+    @staticmethod
+    def _unwrap(inputs):
+        """Return the plain inputs of items taken from the input queue"""
+        unwrapped = []
+        for input in inputs:
+            if isinstance(input, _Queued):
+                input = input.input
+
+            if isinstance(input, _Crashed):
+                input = input.input
+
+            if isinstance(input, _Chunk):
+                unwrapped.extend(input)
+            elif isinstance(input, _Task):
+                unwrapped.append(input.input)
+            else:
+                unwrapped.append(input)
+
+        return unwrapped
+
+    def _fail_futures(self, reason="stopped before call finished"):
+        for id, future in self._futures.items():
+            future._finish(exception=self.Error(reason))
+            self._futures.pop(id, None)
+            self._tasks.pop(id, None)
+
+        if self._ready is not None:
+            self._ready.set()
+
+    def _recall(self):
+        """Like stop() but leave the workers running.
+
+        Takes back queued inputs, waits for calls in progress to finish and
+        collects their return values, then returns the unprocessed inputs.
+        """
+        aborted = self._take_queued()
+        self._unbound_results()
+
+        while True:
+            for q_input in self._input_queues():
+                while True:
+                    try:
+                        aborted.append(q_input.get(False))
+                    except Empty:
+                        break
+
+            # a call that is retried may put its input back
+            for worker in self.workers:
+                if worker.is_alive():
+                    worker.wait(self.LIVENESS_INTERVAL)
+
+            if self._queue_depth() == 0 and \
+               not [ worker for worker in self.workers if worker.is_busy() ]:
+                break
+
+        aborted = self._unwrap(aborted)
+
+        # wait for the results vacuum to store what's left
+        while self._completed + len(aborted) < self._submitted and self.any_alive():
+            self._arrived.clear()
+            if self._completed + len(aborted) >= self._submitted:
+                break
+            self._arrived.wait(self.LIVENESS_INTERVAL)
+
+        self._fail_futures()
+        self._tasks.clear()
+        return aborted
+
+    def _reset(self):
+        """Forget the results and counts of previous use"""
+        self._results.clear()
+        del self.failed[:]
+        del self.dead_letters[:]
+
+        self._counter_lock.acquire()
+        try:
+            self._submitted = self._completed = 0
+            self._idle.set()
+        finally:
+            self._counter_lock.release()
+
+    def __call__(self, *args, **kws):
+        """Queue a call with 'args'.
+
+        Keyword arguments:
+
+        'chunksize': override the pool's chunksize for this call (e.g.,
+                     chunksize=1 to send an urgent input immediately)
+
+        'priority', 'deadline': see Parallelize docstring (needs
+                                priorities=True). Prioritized calls are
+                                never chunked.
+        """
+        chunksize = kws.pop('chunksize', self.chunksize)
+        priority, deadline = self._scheduling(kws)
+
+        if len(args) == 1:
+            input = args[0]
+        else:
+            input = args
+
+        if deadline is not None or self.journal:
+            self._submit_task(input, None, priority, deadline)
+            return
+
+        if priority:
+            self.flush()
+            self._submit(input, 1, priority)
+            return
+
+        if self.task_timeout is not None:
+            if chunksize > 1:
+                raise self.Error("task_timeout doesn't support chunksize > 1")
+
+            self._submit_task(input)
+            return
+
+        if chunksize <= 1 and not self._pending:
+            self._submit(input)
+            return
+
+        self._pending.append(input)
+        if len(self._pending) >= chunksize:
+            self.flush()
+
+    def _scheduling(self, kws):
+        """Pop and check the priority and deadline keyword arguments"""
+        priority = kws.pop('priority', 0)
+        deadline = kws.pop('deadline', None)
+        if kws:
+            raise TypeError("unexpected keyword arguments: %s" % ", ".join(kws))
+
+        if (priority or deadline is not None) and not self.priorities:
+            raise self.Error("priority and deadline need priorities=True")
+
+        return priority, deadline
+
+    def submit(self, *args, **kws):
+        """Queue a call with 'args' and return a Future for its return value
+
+        Keyword arguments: 'priority', 'deadline' (see __call__)
+        """
+        priority, deadline = self._scheduling(kws)
+
+        if len(args) == 1:
+            input = args[0]
+        else:
+            input = args
+
+        future = Future()
+        self._submit_task(input, future, priority, deadline)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def _unbound_results(self):
+        self._results_vacuum.maxsize = 0
+        self._results_vacuum.room.set()
+
+    def __exit__(self, type, value, tb):
+        # results left unconsumed at the end of the block would deadlock
+        # wait() if they were capped
+        self._unbound_results()
+        self.wait(keepalive=False)
+        self.stop()
+
+    def __del__(self):
+        self.stop()
+
+class WarmPool:
+    """Long-lived workers that short-lived pools lease instead of starting
+    their own.
+
+    Workers are started once, with 'preload' modules imported first so they
+    inherit them, and Deferred executors are initialized once per worker.
+    lease() then returns a ready Parallelize that uses these workers. Its
+    stop() (or the end of its with block) returns the workers to the warm
+    pool instead of stopping them, after taking back unprocessed inputs
+    and waiting for calls in progress.
+
+    Only one lease can be out at a time. While it is, lease() falls back to
+    starting a new cold Parallelize with the same executors.
+
+    Usage:
+
+        warm = WarmPool([ Deferred(Executor) ] * 4, preload=['numpy'])
+
+        for batch in batches:
+            with warm.lease() as pool:
+                for input in batch:
+                    pool(input)
+                pool.wait()
+                handle(pool.results)
+
+        warm.close()
+    """
+    def __init__(self, executors, preload=(), **kws):
+        """'kws' are passed to Parallelize, except for journal which a warm
+        pool doesn't support"""
+        if kws.get('journal') is not None:
+            raise Parallelize.Error("a warm pool doesn't support journal")
+
+        for module in preload:
+            __import__(module)
+
+        self.executors = executors
+        self.kws = kws
+
+        self._pool = Parallelize(executors, **kws)
+        self._leased = False
+
+        for worker in self._pool.workers:
+            worker.initialized.wait()
+
+    def lease(self, chunksize=None):
+        """Return a Parallelize that uses the warm workers. 'chunksize'
+        defaults to the warm pool's"""
+        if self._pool is None:
+            raise Parallelize.Error("warm pool is closed")
+
+        if self._leased:
+            kws = dict(self.kws)
+            if chunksize is not None:
+                kws['chunksize'] = chunksize
+            return Parallelize(self.executors, **kws)
+
+        pool = self._pool
+        pool._reset()
+        pool.chunksize = chunksize or self.kws.get('chunksize', 1)
+
+        pool._lease = self
+        self._leased = True
+
+        return pool
+
+    def _release(self, pool):
+        aborted = pool._recall()
+
+        pool._lease = None
+        self._leased = False
+
+        return aborted
+
+    def close(self):
+        """Stop the warm workers"""
+        if self._pool is None:
+            return
+
+        pool, self._pool = self._pool, None
+        if self._leased:
+            self._release(pool)
+        pool.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    @classmethod
+    def for_map(cls, max_procs, f, ordered=False, **kws):
+        """Return a warm pool for parallel_map(max_procs, f, ordered=ordered)"""
+        if ordered:
+            executor = _Indexed(f)
+        else:
+            executor = f
+
+        warm = cls([ executor ] * max_procs, **kws)
+        warm.map_function = f
+        warm.map_ordered = ordered
+
+        return warm
+
+class Coordinator:
+    """Accepts worker agents (see run_agent) for a Parallelize.
+
+    'address' is a (host, port) tuple to listen on TCP, or the path of a
+    Unix socket. Use port 0 to pick a free port and read .address.
+
+    'authkey' is the secret agents must also have (see run_agent). The
+    default is our process's multiprocessing authkey, which agents
+    started as our child processes inherit. Agents on other hosts need
+    it passed explicitly. It only authenticates: traffic isn't encrypted
+    and is unpickled, so only listen on a trusted network.
+
+    Each agent that connects becomes a Parallelize.RemoteWorker in the
+    pool's workers. The pool mustn't use task_timeout or the "steal"
+    scheduler. Closed by the pool's stop().
+    """
+    # how long a connecting agent gets to authenticate
+    AUTH_TIMEOUT = 5
+
+    def __init__(self, pool, address, authkey=None):
+        if pool.task_timeout is not None or pool.scheduler != "shared":
+            raise Parallelize.Error("remote workers don't support task_timeout or scheduler='steal'")
 
-                    try:
-                        if isinstance(input, tuple):
-                            retval = executor(*input)
-                        else:
-                            retval = executor(input)
-                        q_output.put(retval)
+        if isinstance(address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            if os.path.exists(address):
+                os.remove(address)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-                    except cls.Retry:
-                        q_input.put(input)
+        if authkey is None:
+            authkey = current_process().authkey
 
-                    except: # uncaught exceptions destroy worker
-                        if retval is UNDEFINED:
-                            q_input.put(input)
+        sock.bind(address)
+        sock.listen(16)
 
-                        raise
+        self.sock = sock
+        self.address = sock.getsockname()
+        self.pool = pool
+        self.accepting = True
 
-                    finally:
-                        idle.set()
+        pool.coordinator = self
 
-            except cls.Terminated:
-                pass # just exit peacefully
+        def accept():
+            try:
+                conn, peer = sock.accept()
+            except socket.error:
+                return False
 
-        def __init__(self, q_input, q_output, executor):
-            self.initialized = Event()
-            self.idle = Event()
-            self.done = Event()
+            if isinstance(address, tuple):
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-            self.idle.set()
+            conn.settimeout(self.AUTH_TIMEOUT)
+            try:
+                _authenticate(conn, authkey, server=True)
+            except (socket.error, EOFError, AuthenticationError):
+                conn.close()
+                return
+            conn.settimeout(None)
 
-            Process.__init__(self,
-                             target=self.worker,
-                             args=(self.initialized, self.done, self.idle, q_input, q_output, executor))
+            worker = pool.RemoteWorker(pool.q_input, pool.q_output, conn,
+                                       peer or "unix")
+            worker.start()
+            pool.workers.append(worker)
 
-        def is_busy(self):
-            return self.is_alive() and not self.idle.is_set()
+        self._acceptor = ThreadLoop(accept)
 
-        def is_initialized(self):
-            return self.initialized.is_set()
+    def close(self):
+        """Stop accepting agents (doesn't disconnect connected agents)"""
+        if not self.accepting:
+            return
 
-        def is_stopped(self):
-            return self.done.is_set()
+        self.accepting = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self._acceptor.stop()
+
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+def run_agent(address, executor, procs=None, window=None, backend="process",
+              authkey=None):
+    """Connect to the Coordinator at 'address' and run calls for it with
+    'executor' in a local pool of 'procs' workers until the coordinator
+    stops or disconnects.
+
+    'window': how many inputs to pull ahead (default: 4 per worker)
+    'authkey': the coordinator's authkey (default: our process's
+               multiprocessing authkey). Raises AuthenticationError if
+               the coordinator doesn't have it.
+    """
+    import multiprocessing
 
-        def wait(self, timeout=None):
-            """wait until Worker is idle"""
-            return self.idle.wait(timeout)
+    if procs is None:
+        procs = multiprocessing.cpu_count()
+    if window is None:
+        window = procs * 4
+    if authkey is None:
+        authkey = current_process().authkey
 
-        def stop(self):
-            """let worker finish what it was doing and join"""
-            if not self.is_alive():
-                return
+    # start the workers before connecting so they don't inherit the socket
+    # and keep the connection open after the agent dies
+    pool = Parallelize([ _Indexed(executor) ] * procs, backend=backend)
 
-            self.done.set()
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+        if not isinstance(address, str):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-    class IterResults:
-        def __init__(self, parent):
-            self.parent = parent
-            self.yielded = 0
+        _authenticate(sock, authkey, server=False)
 
-        def __iter__(self):
-            self.yielded = 0
-            return self
+        _send_message(sock, ("hello", procs))
+        _send_message(sock, ("pull", window))
 
-        def next(self):
-            finished = False
+        def send_results():
+            pool.ready.clear()
 
-            while True:
-                if len(self.parent._results) > self.yielded:
-                    result = self.parent._results[self.yielded]
-                    self.yielded += 1
-                    return result
+            batch = []
+            while pool._results:
+                batch.append(pool._results.popleft())
+            pool._results_vacuum.room.set()
 
-                if not finished:
-                    finished = self.parent.wait(block=False)
+            if batch:
+                _send_message(sock, ("results", batch))
 
-                if finished and self.yielded == len(self.parent._results):
-                    raise StopIteration
+        while True:
+            readable = select.select([ sock, pool ], [], [], 1.0)[0]
+
+            if pool in readable:
+                send_results()
+
+            # a worker died without raising and lost its call (see
+            # Parallelize._lost), or none are left: disconnect so the
+            # coordinator gives what we have to other workers
+            lost = [ worker for worker in pool.workers
+                     if worker.started.value and pool._lost(worker) ]
+            if lost or not pool.any_alive():
+                send_results()
+                break
+
+            if sock in readable:
+                try:
+                    message = _recv_message(sock)
+                except (socket.error, EOFError):
+                    break
 
-        def __len__(self):
-            return len(self.parent._results)
+                if message[0] == "tasks":
+                    for seq, input, catch in message[1]:
+                        if catch:
+                            pool(seq, input, True)
+                        else:
+                            pool(seq, input)
 
-        def __getitem__(self, key):
-            return self.parent._results[key]
+                elif message[0] == "stop":
+                    aborted = pool.stop()
+                    send_results()
+                    _send_message(sock, ("aborted", [ args[0] for args in aborted ]))
+                    break
+    finally:
+        pool.stop()
+        sock.close()
 
-        def __repr__(self):
-            return repr(self.parent._results)
+class _Indexed:
+    """Executor wrapper that tags return values with the index of their input.
 
-    def __init__(self, executors):
-        for executor in executors:
-            if not callable(executor):
-                raise self.Error("executor %s is not callable" % `executor`)
+    With 'catch' set, returns (index, retval, exception) instead and an
+    exception the call raises doesn't crash the worker (see
+    Parallelize.Worker._call_exception)
+    """
+    def __init__(self, executor):
+        self.executor = executor
 
-        q_input = WaitableQueue()
-        q_output = WaitableQueue()
+    def __call__(self, index, input, catch=False):
+        if isinstance(self.executor, Deferred):
+            self.executor = self.executor()
 
-        self.workers = []
-        for executor in executors:
-            worker = self.Worker(q_input, q_output, executor)
-            worker.start()
+        if not catch:
+            return index, Parallelize.Worker._execute(self.executor, input)
 
-            self.workers.append(worker)
+        try:
+            return index, Parallelize.Worker._execute(self.executor, input), None
+        except (Parallelize.Worker.Retry, Parallelize.Worker.Terminated):
+            raise
+        except Exception:
+            return index, None, Parallelize.Worker._call_exception()
 
-        self.size = len(executors)
+def parallel_map(max_procs, f, sequence, chunksize=1, ordered=False, window=None,
+                 backend="process", warm=None):
+    """Map 'f' over 'sequence' in up to 'max_procs' processes and yield results.
 
-        self.q_input = q_input
+    'chunksize': send inputs to workers in chunks (see Parallelize)
 
-        self._results = []
-        self._results_vacuum = WaitableQueue.Vacuum(q_output, self._results)
+    'ordered': yield results in the order of their inputs instead of in the
+               order they complete. Results that complete early are held in
+               a reorder buffer until their turn comes.
 
-        self.results = self.IterResults(self)
+    'window': if set, 'sequence' is consumed lazily and no more than 'window'
+              inputs are taken from it ahead of the last result yielded.
+              Inputs in flight plus the reorder buffer never exceed 'window'
+              items, so memory stays O(window) however long the sequence.
 
-    def any_alive(self):
-        """Return True if any workers are alive, else False"""
-        for worker in self.workers:
-            if worker.is_alive():
-                return True
+    'backend': "process" or "thread" (see Parallelize)
 
-        return False
+    'warm': lease workers from this WarmPool (see WarmPool.for_map) instead
+            of starting max_procs new ones
+    """
+    if warm is not None and (getattr(warm, 'map_function', None) is not f or
+                             warm.map_ordered != ordered):
+        raise Parallelize.Error("warm pool wasn't made with WarmPool.for_map for this f and ordered")
 
-    def _wait_nonblock(self, keepalive=True, keepalive_spares=0):
+    if window is None:
+        items = list(sequence)
+        if not items:
+            return
 
-        def find_busy_worker():
-            for worker in self.workers:
-                if not worker.is_alive() or worker.is_stopped():
-                    continue
+        chunks = (len(items) + chunksize - 1) / chunksize
+        if max_procs > chunks:
+            max_procs = chunks
 
-                if worker.is_initialized() and worker.is_busy():
-                    return worker
+        window = len(items)
+    else:
+        if window < 1:
+            raise Parallelize.Error("window must be at least 1 (not %d)" % window)
 
-        # gauntlet of checks to make sure the input queue is empty and all
-        # workers are idle
+        items = sequence
 
-        self.q_input.wait_empty(0.1)
+    if max_procs == 1 and warm is None:
+        for item in items:
+            yield f(item)
 
-        if not self.any_alive():
-            return True
+        return
 
-        saved_put_counter = self.q_input.put_counter
+    if ordered:
+        executor = _Indexed(f)
+    else:
+        executor = f
 
-        if not keepalive:
+    items = iter(items)
+    if warm is not None:
+        pool = warm.lease(chunksize)
+    else:
+        pool = Parallelize([executor] * max_procs, chunksize, backend=backend)
 
-            # if input queue is empty and keepalive is False shutdown idle workers
-            if self.q_input.qsize() != 0:
-                return False
+    with pool:
+        results = pool.consume_results()
 
-            idle_workers = [ worker for worker in self.workers
-                                if worker.is_alive() and \
-                                not worker.is_busy() and \
-                                not worker.is_stopped() ]
+        reorder = {}
+        submitted = 0
+        yielded = 0
+        exhausted = False
 
-            if len(idle_workers) > keepalive_spares:
-                for worker in idle_workers:
+        while True:
+            while not exhausted and submitted - yielded < window:
+                try:
+                    item = items.next()
+                except StopIteration:
+                    exhausted = True
+                    break
 
-                    # check is_busy() again just to make sure
-                    if not worker.is_busy():
-                        worker.stop()
-                        break
+                if ordered:
+                    pool(submitted, item)
+                else:
+                    pool(item)
+                submitted += 1
 
-                return False
+            pool.flush()
 
-        busy_worker = find_busy_worker()
-        if busy_worker:
-            return False
+            if yielded == submitted:
+                break
 
-        # give puts to the input Queue a chance to make it through
-        time.sleep(0.1)
+            try:
+                result = results.next()
+            except StopIteration: # no workers left
+                break
 
-        # workers may have written to the input Queue
-        if self.q_input.put_counter != saved_put_counter:
-            return False
+            if not ordered:
+                yielded += 1
+                yield result
+                continue
 
-        return True
+            index, result = result
+            reorder[index] = result
 
-    def wait(self, keepalive=True, keepalive_spares=0, block=True):
-        """wait for all input to be processed by workers.
+            while yielded in reorder:
+                result = reorder.pop(yielded)
+                yielded += 1
+                yield result
 
-        Returns True if finished (always True when block=True) else False
+class AsyncParallelize:
+    """Drive a Parallelize from an asyncio style event loop (e.g., trollius)
+    without blocking the loop or polling it from threads.
 
-        Arguments:
+    The loop watches the pool's file descriptor (see Parallelize.fileno)
+    and only the loop's thread touches loop futures. The descriptor only
+    becomes readable when something is collected, so every
+    LIVENESS_INTERVAL the loop also checks for workers that died. 'loop'
+    needs add_reader(), remove_reader(), call_later() and create_future().
 
-        If keepalive=False: stop idle workers once there's nothing left to do.
-        If keepalive=False and keepalive_spares > 0: keep alive at least
-        keepalive_spares spare workers.
+    Usage example (trollius)::
 
-        """
+        apool = AsyncParallelize(Parallelize([ f ] * 4), loop)
+
+        result = yield From(apool.submit(x))
+
+        for x in inputs:
+            apool(x)
 
         while True:
+            try:
+                result = yield From(apool.next_result())
+            except AsyncParallelize.Drained:
+                break
 
-            finished = self._wait_nonblock(keepalive, keepalive_spares)
-            if finished or not block:
-                return finished
+        yield From(apool.drain())
+        apool.close()
+    """
+    class Drained(Exception):
+        pass
 
-            time.sleep(0.1)
+    def __init__(self, pool, loop):
+        self.pool = pool
+        self.loop = loop
 
-    def stop(self, finish_timeout=None):
-        """Stop workers and return any unprocessed input values"""
+        # (pool future, loop future) pairs completed by the vacuum thread
+        self._completed = deque()
 
-        if not self.workers:
-            return
+        self._result_waiters = deque()
+        self._drain_waiters = []
 
-        # ignore SIGINT and SIGTERM for now (restore later)
-        sigint_handler = signal.getsignal(signal.SIGINT)
-        sigterm_handler = signal.getsignal(signal.SIGTERM)
+        self._fd = pool.fileno()
+        loop.add_reader(self._fd, self._dispatch)
 
-        signal.signal(signal.SIGINT, signal.SIG_IGN)
-        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        self._timer = loop.call_later(pool.LIVENESS_INTERVAL, self._check_liveness)
 
-        for worker in self.workers:
-            worker.stop()
+    def close(self):
+        """Stop watching the pool (doesn't stop the pool)"""
+        self.loop.remove_reader(self._fd)
+        self._timer.cancel()
 
-        aborted = []
-        inputs_vacuum = WaitableQueue.Vacuum(self.q_input, aborted)
+    def _check_liveness(self):
+        # the pool's wait(), called by _dispatch, accounts for dead workers
+        self._dispatch()
+        self._timer = self.loop.call_later(self.pool.LIVENESS_INTERVAL,
+                                           self._check_liveness)
 
-        started = time.time()
+    def __call__(self, *args):
+        """Queue a call whose return value goes to next_result()"""
+        self.pool(*args)
 
-        try:
-            while True:
-                if not self.any_alive():
-                    break
+    def submit(self, *args):
+        """Queue a call and return a loop future for its return value"""
+        future = self.loop.create_future()
 
-                if finish_timeout is not None and (time.time() - started) > finish_timeout:
-                    break
+        def callback(pool_future):
+            self._completed.append((pool_future, future))
 
-                time.sleep(0.1)
+        self.pool.submit(*args).add_done_callback(callback)
+        return future
 
-            for worker in self.workers:
-                if worker.is_alive():
-                    worker.terminate()
+    def next_result(self):
+        """Return a loop future for the next return value from a plain call.
 
-            for worker in self.workers:
-                if worker.is_alive():
-                    worker.join()
+        Fails with AsyncParallelize.Drained once nothing is left in flight"""
+        future = self.loop.create_future()
+        self._result_waiters.append(future)
+        self._dispatch()
 
-            self.workers = []
-        finally:
-            time.sleep(0.1)
-            inputs_vacuum.stop()
+        return future
 
-        self._results_vacuum.stop()
+    def drain(self):
+        """Return a loop future that's done once nothing is left in flight"""
+        future = self.loop.create_future()
+        self._drain_waiters.append(future)
+        self._dispatch()
 
-        signal.signal(signal.SIGINT, sigint_handler)
-        signal.signal(signal.SIGTERM, sigterm_handler)
+        return future
 
-        return aborted
+    def _resolve_completed(self):
+        while self._completed:
+            pool_future, future = self._completed.popleft()
+            if future.cancelled():
+                continue
 
-    def __call__(self, *args):
-        if len(args) == 1:
-            self.q_input.put(args[0])
-        else:
-            self.q_input.put(args)
+            exception = pool_future.exception(0)
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(pool_future.result(0))
 
-    def __enter__(self):
-        return self
+    def _dispatch(self):
+        self.pool.ready.clear()
 
-    def __exit__(self, type, value, tb):
-        self.wait(keepalive=False)
-        self.stop()
+        self._resolve_completed()
 
-    def __del__(self):
-        self.stop()
+        results = self.pool._results
+        while self._result_waiters and results:
+            future = self._result_waiters.popleft()
+            if future.cancelled():
+                continue
 
-def parallel_map(max_procs, f, sequence):
-    items = list(sequence)
-    if not items:
-        return
+            future.set_result(results.popleft())
+            self.pool._results_vacuum.room.set()
 
-    if max_procs > len(items):
-        max_procs = len(items)
+        finished = self.pool.wait(block=False)
 
-    if max_procs == 1:
-        for item in items:
-            yield f(item)
+        # wait() may have failed futures (e.g., no workers left)
+        self._resolve_completed()
 
-    else:
-        with Parallelize([f] * max_procs) as executor:
-            for item in items:
-                executor(item)
+        if not finished:
+            return
 
-            for result in executor.results:
-                yield result
+        while self._result_waiters:
+            future = self._result_waiters.popleft()
+            if not future.cancelled():
+                future.set_exception(self.Drained())
+
+        drain_waiters, self._drain_waiters = self._drain_waiters, []
+        for future in drain_waiters:
+            if not future.cancelled():
+                future.set_result(None)
 
 def test():
     import time
@@ -594,5 +3630,312 @@ def test5():
 
     print "results: " + `square.results`
 
+def benchmark_wait(procs=4, batches=5):
+    """measure how much wait() adds on top of the work itself"""
+
+    print "%10s %12s %12s" % ("job (s)", "elapsed (s)", "overhead (ms)")
+
+    pool = Parallelize([ time.sleep ] * procs)
+    try:
+        for job in (0, 0.001, 0.01, 0.1, 0.5):
+            overheads = []
+            for i in range(batches):
+                started = time.time()
+                for j in range(procs):
+                    pool(job)
+                pool.wait()
+
+                elapsed = time.time() - started
+                overheads.append(elapsed - job)
+
+            overhead = sum(overheads) / len(overheads)
+            print "%10.3f %12.4f %12.2f" % (job, job + overhead, overhead * 1000)
+    finally:
+        pool.stop()
+
+def benchmark_queue(items=200000, batch=64):
+    """compare items/sec through a WaitableQueue with put/get vs. put_many/get_many"""
+
+    def produce(q, go, count, batched):
+        go.wait()
+        if batched:
+            for i in range(0, count, batch):
+                q.put_many(range(i, min(i + batch, count)))
+        else:
+            for i in range(count):
+                q.put(i)
+
+    def consume(q, go, batched):
+        go.wait()
+        while True:
+            if batched:
+                vals = q.get_many(batch)
+            else:
+                vals = [ q.get() ]
+
+            if None in vals:
+                # leave the other consumers their stop sentinels
+                extra = vals.count(None) - 1
+                if extra:
+                    q.put_many([ None ] * extra)
+                return
+
+    for procs in (1, 4, 16):
+        for batched in (False, True):
+            q = WaitableQueue()
+            go = Event()
+
+            producers = [ Process(target=produce, args=(q, go, items / procs, batched))
+                          for i in range(procs) ]
+            consumers = [ Process(target=consume, args=(q, go, batched))
+                          for i in range(procs) ]
+            for process in producers + consumers:
+                process.start()
+
+            started = time.time()
+            go.set()
+
+            for process in producers:
+                process.join()
+            for process in consumers:
+                q.put(None)
+            for process in consumers:
+                process.join()
+
+            elapsed = time.time() - started
+
+            print "producers=consumers=%-3d %-17s %10.0f items/s" % \
+                  (procs, "put_many/get_many" if batched else "put/get",
+                   (items / procs * procs) / elapsed)
+
+def benchmark_iter_cpu(procs=8, seconds=1.0, rounds=3):
+    """measure consumer CPU time while iterating over results of sleeping workers"""
+
+    def cputime():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    pool = Parallelize([ time.sleep ] * procs)
+    try:
+        for i in range(rounds):
+            for j in range(procs):
+                pool(seconds)
+
+            started = time.time()
+            cpu_started = cputime()
+
+            for result in pool.consume_results():
+                pass
+
+            elapsed = time.time() - started
+            cpu = cputime() - cpu_started
+            print "waited %.2fs, consumer cpu %.3fs (%.1f%%)" % (elapsed, cpu,
+                                                                 cpu * 100 / elapsed)
+    finally:
+        pool.stop()
+
+def benchmark_shm(procs=4, size=8 << 20, calls=64):
+    """compare throughput of large return values via pipes vs. shared memory"""
+
+    import operator
+
+    for shm_threshold in (None, 64 << 10):
+        pool = Parallelize([ operator.mul ] * procs, shm_threshold=shm_threshold)
+        try:
+            started = time.time()
+            for i in range(calls):
+                pool('x', size)
+
+            total = 0
+            for result in pool.consume_results():
+                total += len(result)
+
+            elapsed = time.time() - started
+        finally:
+            pool.stop()
+
+        print "shm_threshold=%-8s %6.1f MB/s" % (shm_threshold,
+                                                (total / elapsed) / (1 << 20))
+
+def benchmark_steal(max_procs=None, calls=20000):
+    """compare throughput of small calls with a shared vs. per-worker queues"""
+
+    import multiprocessing
+
+    if max_procs is None:
+        max_procs = multiprocessing.cpu_count()
+
+    procs = 1
+    while True:
+        for scheduler in ("shared", "steal"):
+            pool = Parallelize([ abs ] * procs, scheduler=scheduler)
+            try:
+                started = time.time()
+                for i in range(calls):
+                    pool(-i)
+                pool.wait()
+
+                elapsed = time.time() - started
+            finally:
+                pool.stop()
+
+            print "procs=%-3d scheduler=%-6s %8.0f calls/s" % (procs, scheduler,
+                                                              calls / elapsed)
+
+        if procs >= max_procs:
+            break
+        procs = min(procs * 2, max_procs)
+
+def benchmark_journal(procs=2, calls=20000):
+    """compare throughput of small calls with and without a journal"""
+
+    import tempfile
+
+    path = tempfile.mktemp(prefix="journal-")
+    try:
+        for journal in (None, path):
+            pool = Parallelize([ abs ] * procs, journal=journal)
+            try:
+                started = time.time()
+                for i in range(calls):
+                    pool(-i)
+                pool.wait()
+
+                elapsed = time.time() - started
+            finally:
+                pool.stop()
+
+            print "journal=%-5s %8.0f calls/s" % (journal is not None, calls / elapsed)
+
+        print "journal size after completion: %d bytes" % os.path.getsize(path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def _compress(rounds):
+    import zlib
+
+    data = "".join([ chr(i * 7 % 251) for i in range(1 << 16) ])
+    for i in range(rounds):
+        zlib.compress(data, 9)
+
+    return rounds
+
+def benchmark_affinity(procs=None, calls=200, rounds=20):
+    """compare throughput of a CPU-bound executor with and without pinning"""
+
+    import multiprocessing
+
+    if procs is None:
+        procs = multiprocessing.cpu_count()
+
+    for placement in (None, "core", "numa"):
+        pool = Parallelize([ _compress ] * procs, placement=placement)
+        try:
+            started = time.time()
+            for i in range(calls):
+                pool(rounds)
+            pool.wait()
+
+            elapsed = time.time() - started
+        finally:
+            pool.stop()
+
+        print "placement=%-7s %6.1f calls/s" % (placement, calls / elapsed)
+
+class _SlowStart:
+    """Executor that takes a while to initialize, like one with heavy imports"""
+    def __init__(self, seconds):
+        time.sleep(seconds)
+
+    def __call__(self, x):
+        return x
+
+def benchmark_warm(procs=4, pools=10, init=0.2):
+    """compare running many short-lived pools cold vs. leased from a WarmPool"""
+
+    executors = [ Deferred(_SlowStart, init) ] * procs
+
+    def run(pool):
+        for i in range(10):
+            pool(i)
+        pool.wait()
+        assert len(pool.results) == 10
+
+    started = time.time()
+    for i in range(pools):
+        pool = Parallelize(executors)
+        run(pool)
+        pool.stop()
+    cold = time.time() - started
+
+    warm = WarmPool(executors)
+    try:
+        started = time.time()
+        for i in range(pools):
+            with warm.lease() as pool:
+                run(pool)
+        leased = time.time() - started
+    finally:
+        warm.close()
+
+    print "cold: %.3f seconds per pool" % (cold / pools)
+    print "warm: %.3f seconds per pool" % (leased / pools)
+
+def benchmark_remote(agents=2, procs=2, calls=2000):
+    """compare throughput and latency of a local pool vs. agents on localhost"""
+
+    import operator
+
+    def measure(pool):
+        started = time.time()
+        for i in range(calls):
+            pool(i, 2)
+        pool.wait()
+        assert len(pool.results) == calls
+        throughput = calls / (time.time() - started)
+
+        latencies = []
+        for i in range(50):
+            started = time.time()
+            pool.submit(i, 2).result()
+            latencies.append(time.time() - started)
+        latencies.sort()
+
+        return throughput, latencies[len(latencies) / 2]
+
+    pool = Parallelize([ operator.mul ] * (agents * procs))
+    try:
+        throughput, latency = measure(pool)
+    finally:
+        pool.stop()
+    print "local:  %8.0f calls/s, %6.2f ms median latency" % (throughput, latency * 1000)
+
+    for address in (("127.0.0.1", 0), "/tmp/parallelize-benchmark-%d.sock" % os.getpid()):
+        pool = Parallelize([])
+        coordinator = Coordinator(pool, address)
+
+        processes = [ Process(target=run_agent,
+                              args=(coordinator.address, operator.mul, procs))
+                      for i in range(agents) ]
+        for process in processes:
+            process.start()
+
+        try:
+            while len(pool.workers) < agents:
+                time.sleep(0.01)
+            for worker in pool.workers:
+                worker.initialized.wait()
+
+            throughput, latency = measure(pool)
+        finally:
+            pool.stop()
+            for process in processes:
+                process.join()
+
+        print "remote (%s): %8.0f calls/s, %6.2f ms median latency" % \
+              ("tcp" if isinstance(address, tuple) else "unix",
+               throughput, latency * 1000)
+
 if __name__ == "__main__":
     test5()
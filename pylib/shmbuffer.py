@@ -0,0 +1,128 @@
+"""
+Pass large strings between processes through shared memory.
+
+share() writes a string into a shared memory segment (a file in /dev/shm)
+and returns a small, picklable ShmHandle. Whoever receives the handle calls
+its open() method, which maps the segment and returns a SharedBuffer: a
+read-only view of the string that doesn't copy it.
+
+Lifetime rules:
+
+- A segment belongs to its handle until the handle is opened (or
+  discarded). Handles that never get opened leak their segment, so use a
+  prefix you can cleanup() by.
+
+- open() unlinks the segment right after mapping it. From then on the
+  memory lives only as long as the SharedBuffer: it's freed by close() or
+  when the SharedBuffer is garbage collected.
+
+- A handle can only be opened once.
+"""
+import os
+import mmap
+import glob
+import tempfile
+from os.path import *
+
+SHM_DIR = '/dev/shm'
+
+def _shm_dir():
+    if isdir(SHM_DIR):
+        return SHM_DIR
+
+    return None
+
+class SharedBuffer(object):
+    """Read-only view of a string in a mapped shared memory segment.
+
+    len(), indexing, slicing and str() work like on a string (slicing and
+    str() copy). buffer() returns a zero-copy buffer object you can write
+    to a file or socket.
+
+    Pickling a SharedBuffer pickles a copy of the string.
+    """
+    def __init__(self, mm, size):
+        self._mm = mm
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, key):
+        return self._mm[key]
+
+    def __str__(self):
+        return self._mm[:]
+
+    def __repr__(self):
+        return "SharedBuffer(%d bytes)" % self._size
+
+    def __reduce__(self):
+        return (str, (str(self),))
+
+    def buffer(self, offset=0, size=None):
+        if size is None:
+            return buffer(self._mm, offset)
+
+        return buffer(self._mm, offset, size)
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+class ShmHandle(object):
+    """Picklable reference to a string in a shared memory segment"""
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def open(self):
+        """Map the segment, unlink it and return a SharedBuffer"""
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            mm = mmap.mmap(fd, self.size, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(fd)
+            os.unlink(self.path)
+
+        return SharedBuffer(mm, self.size)
+
+    def discard(self):
+        """Free the segment without opening it"""
+        if exists(self.path):
+            os.unlink(self.path)
+
+    def __repr__(self):
+        return "ShmHandle(%s, %d)" % (`self.path`, self.size)
+
+def share(s, prefix="shmbuffer-"):
+    """Copy string 's' into a new shared memory segment and return its ShmHandle"""
+    if not s:
+        raise ValueError("can't share an empty string")
+
+    fd, path = tempfile.mkstemp(prefix=prefix, dir=_shm_dir())
+    try:
+        written = 0
+        while written < len(s):
+            written += os.write(fd, buffer(s, written))
+    except:
+        os.unlink(path)
+        raise
+    finally:
+        os.close(fd)
+
+    return ShmHandle(path, len(s))
+
+def cleanup(prefix):
+    """Remove unopened segments created with 'prefix'"""
+    dir = _shm_dir() or tempfile.gettempdir()
+    for path in glob.glob(join(dir, prefix + "*")):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,27 @@
+"""
+Low-level OS helpers shared by modules that go below the os module.
+"""
+import os
+import fcntl
+import ctypes
+import ctypes.util
+
+_libc = None
+def libc():
+    """Return the C library, loaded once. Functions called through it set
+    ctypes.get_errno() on failure."""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+
+    return _libc
+
+def nonblocking_pipe():
+    """Return a pipe (r, w) with both ends non-blocking"""
+    r, w = os.pipe()
+    for fd in (r, w):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    return r, w